@@ -0,0 +1,71 @@
+import os
+import warnings
+
+import torch
+
+from ObjectDetector.utils.utils import non_max_suppression
+
+# Runtimes a detector can be served with:
+#   torch        eager Darknet
+#   torchscript  CompiledDarknet, traced and frozen
+#   onnxruntime  OnnxRuntimeBackend, CPU only
+#   int8         CompiledDarknet of the int8 model published by quantize.py, CPU only
+# Every one is called with a batch of images and returns the dense (samples, boxes, 5 + classes)
+# output, and detect(imgs, conf_thres, nms_thres) returns the detections of each image
+backends = ("torch", "torchscript", "onnxruntime", "int8")
+
+# Precisions of the torch backend, see Darknet.precision
+precisions = ("fp32", "bf16")
+
+
+def model_device(model):
+    """ Device the input images of a model of any backend must be on """
+    device = getattr(model, "device", None)
+    return device if device is not None else next(model.parameters()).device
+
+
+def export_onnx(model, path, img_size, opset_version=12):
+    """
+    Exports the eval-mode 'model' to ONNX. YOLO decoding is part of the graph, so the
+    output matches the dense output of Darknet; the batch dimension is dynamic
+    """
+    device = model_device(model)
+    example = torch.rand(1, 3, img_size, img_size, device=device)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        torch.onnx.export(
+            model,
+            (example,),
+            path,
+            input_names=["images"],
+            output_names=["predictions"],
+            dynamic_axes={"images": {0: "batch"}, "predictions": {0: "batch"}},
+            opset_version=opset_version,
+            dynamo=False,
+        )
+    return path
+
+
+class OnnxRuntimeBackend(object):
+    """ Exported detector run by onnxruntime on the CPU, with the same interface as Darknet """
+
+    def __init__(self, path, img_size, threads=None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.img_size = img_size
+        self.device = torch.device("cpu")
+        self.nbytes = os.path.getsize(path)  # Size of the weights stored in the graph
+
+    def __call__(self, imgs):
+        (predictions,) = self.session.run(None, {"images": imgs.detach().cpu().numpy()})
+        return torch.from_numpy(predictions)
+
+    def detect(self, imgs, conf_thres, nms_thres):
+        """ Inference followed by Non-Maximum Suppression. Returns the detections of each image """
+        return non_max_suppression(self(imgs), conf_thres, nms_thres)
@@ -0,0 +1,469 @@
+"""
+Benchmarks for the live detection pipeline. Run from the repository root, e.g.
+
+    python -m ObjectDetector.benchmark registry --sessions 4
+"""
+from __future__ import division
+
+import argparse
+import copy
+import gc
+import os
+import resource
+import sys
+import time
+
+import torch
+
+from ObjectDetector.model_registry import ModelRegistry, load_model, model_bytes
+
+model_def = "ObjectDetector/config/yolov3-custom.cfg"
+weights_path = "ObjectDetector/weights/yolov3_ckpt_499.pth"
+
+failures = []  # Parity checks that failed, the benchmark exits with a non-zero status if any
+
+
+def rss_bytes():
+    """ Current resident set size of the process (peak size where /proc is not available) """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def anonymous_bytes():
+    """ Private (not file backed) memory of the process, 0 where /proc/self/smaps_rollup is not available """
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Anonymous:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def existing(path):
+    # Benchmarks still run with random weights when the checkpoint has not been downloaded
+    return path if path is not None and os.path.exists(path) else None
+
+
+def bench_registry(opt):
+    """ Memory and setup time of N sessions with one model each versus one shared model """
+    weights = existing(opt.weights_path)
+    device = torch.device("cpu")
+
+    gc.collect()
+    base = rss_bytes()
+    start = time.time()
+    models = [load_model(opt.model_def, weights, opt.img_size, device) for _ in range(opt.sessions)]
+    independent_time = time.time() - start
+    independent_rss = rss_bytes() - base
+    size = model_bytes(models[0])
+    del models
+    gc.collect()
+
+    registry = ModelRegistry()
+    base = rss_bytes()
+    start = time.time()
+    handles = [registry.acquire(opt.model_def, weights, opt.img_size, device) for _ in range(opt.sessions)]
+    shared_time = time.time() - start
+    shared_rss = rss_bytes() - base
+    print(registry.format_memory_report())
+    for handle in handles:
+        handle.release()
+
+    print("Model parameters and buffers: %.1f MB" % (size / 2 ** 20))
+    print("%d independent models: +%.1f MB RSS, %.2f s setup" % (opt.sessions, independent_rss / 2 ** 20, independent_time))
+    print("%d shared sessions:    +%.1f MB RSS, %.2f s setup" % (opt.sessions, shared_rss / 2 ** 20, shared_time))
+    print("Models left in registry after release: %d" % len(registry.memory_report()))
+
+
+def timed(fn, repeats):
+    """ Mean wall time of 'fn' in seconds after one warm-up call """
+    fn()
+    start = time.time()
+    for _ in range(repeats):
+        fn()
+    return (time.time() - start) / repeats
+
+
+def bench_batching(opt):
+    """ Frames per second of the detector when N sessions share one batched forward pass """
+    from ObjectDetector.deteccion_video import infer_batch
+
+    model = load_model(opt.model_def, existing(opt.weights_path), opt.img_size, torch.device("cpu"))
+    for sessions in range(1, opt.sessions + 1):
+        jobs = [(torch.rand(1, 3, opt.img_size, opt.img_size), (540, 720)) for _ in range(sessions)]
+        batched = timed(lambda: infer_batch(model, jobs), opt.repeats)
+        single = timed(lambda: [infer_batch(model, [job]) for job in jobs], opt.repeats)
+        print(
+            "%d sessions: batched %.1f fps (%.0f ms), one by one %.1f fps (%.0f ms)"
+            % (sessions, sessions / batched, 1000 * batched, sessions / single, 1000 * single)
+        )
+
+
+def bench_preprocess(opt):
+    """ Former frame -> tensor chain against the fused FramePreprocessor """
+    import cv2
+    import numpy as np
+    from av import VideoFrame
+    from torchvision import transforms
+    from ObjectDetector.deteccion_video import Convert_RGB
+    from ObjectDetector.utils.datasets import pad_to_square, resize
+    from ObjectDetector.utils.preprocess import FramePreprocessor
+
+    width, height = opt.frame_width, opt.frame_height
+    # Smooth random content, closer to camera frames than per-pixel noise
+    img = cv2.resize(np.random.randint(0, 255, (height // 20, width // 20, 3), dtype=np.uint8), (width, height))
+    frame = VideoFrame.from_ndarray(img, format="bgr24")
+    frame = frame.reformat(format="yuv420p")  # What the decoder hands to DetectionVideo.recv
+
+    def former_chain():
+        img = cv2.resize(frame.to_ndarray(format="bgr24"), (720, 540), interpolation=cv2.INTER_CUBIC)
+        img = transforms.ToTensor()(Convert_RGB(img))
+        img, _ = pad_to_square(img, 0)
+        return resize(img, opt.img_size).unsqueeze(0)
+
+    preprocess = FramePreprocessor(img_size=opt.img_size)
+
+    def fused():
+        buffer, _ = preprocess(frame)
+        preprocess.release(buffer)
+        return buffer
+
+    former = timed(former_chain, opt.repeats)
+    new = timed(fused, opt.repeats)
+    difference = (former_chain() - fused()).abs().mean().item()
+    print("%dx%d frame -> 1x3x%dx%d" % (width, height, opt.img_size, opt.img_size))
+    print("Former chain:       %.2f ms" % (1000 * former))
+    print("FramePreprocessor:  %.2f ms (%.1fx)" % (1000 * new, former / new))
+    print("Mean absolute pixel difference: %.4f" % difference)
+
+
+def synthetic_predictions(batch_size, num_candidates, num_classes=9, num_objects=20):
+    """ Raw detector output with candidates clustered around a few objects, like real YOLO output """
+    prediction = torch.zeros(batch_size, num_candidates, 5 + num_classes)
+    centers = torch.rand(batch_size, num_objects, 2) * 416
+    index = torch.randint(0, num_objects, (batch_size, num_candidates, 1)).expand(-1, -1, 2)
+    prediction[..., :2] = torch.gather(centers, 1, index) + torch.randn(batch_size, num_candidates, 2) * 8
+    prediction[..., 2:4] = 30 + torch.rand(batch_size, num_candidates, 2) * 40
+    prediction[..., 4:] = torch.rand(batch_size, num_candidates, 1 + num_classes)
+    return prediction
+
+
+def bench_nms(opt):
+    """ Vectorized non_max_suppression against the former per-box loop, with a parity check """
+    from ObjectDetector.utils.utils import non_max_suppression, non_max_suppression_loop
+
+    for batch_size in sorted(set([1, 8, opt.batch_size])):
+        for num_candidates in (100, 1000, 5000, 10647):
+            prediction = synthetic_predictions(batch_size, num_candidates)
+            new = timed(lambda: non_max_suppression(prediction.clone(), opt.conf_thres, opt.nms_thres), opt.repeats)
+            former = timed(lambda: non_max_suppression_loop(prediction.clone(), opt.conf_thres, opt.nms_thres), opt.repeats)
+
+            outputs = non_max_suppression(prediction.clone(), opt.conf_thres, opt.nms_thres)
+            expected = non_max_suppression_loop(prediction.clone(), opt.conf_thres, opt.nms_thres)
+            match = all(
+                (a is None and b is None)
+                or (a is not None and b is not None and a.shape == b.shape and torch.allclose(a, b, atol=1e-3))
+                for a, b in zip(outputs, expected)
+            )
+            if not match:
+                failures.append("nms: %d candidates x %d images differ from the loop" % (num_candidates, batch_size))
+            print(
+                "%5d candidates x %d images: vectorized %.1f ms, loop %.1f ms (%.1fx), results %s"
+                % (num_candidates, batch_size, 1000 * new, 1000 * former, former / new, "match" if match else "DIFFER")
+            )
+
+
+def bench_activations(opt):
+    """ Peak memory held by layer outputs during a forward pass, with and without liveness-based release """
+    model = load_model(opt.model_def, existing(opt.weights_path), opt.img_size, torch.device("cpu"))
+    model.track_activations = True
+    for batch_size in sorted(set([1, opt.batch_size])):
+        imgs = torch.rand(batch_size, 3, opt.img_size, opt.img_size)
+        for release in (False, True):
+            model.release_activations = release
+            elapsed = timed(lambda: model(imgs), opt.repeats)
+            print(
+                "batch %d, %d px, %s: peak activations %.1f MB, %.0f ms"
+                % (
+                    batch_size,
+                    opt.img_size,
+                    "released after last use" if release else "all kept",
+                    model.activation_stats["peak_bytes"] / 2 ** 20,
+                    1000 * elapsed,
+                )
+            )
+
+
+def bench_fuse(opt):
+    """ Latency and numerical equivalence of the model before and after folding its batch norms """
+    model = load_model(opt.model_def, existing(opt.weights_path), opt.img_size, torch.device("cpu"), fuse=False)
+    imgs = torch.rand(opt.batch_size, 3, opt.img_size, opt.img_size)
+    expected = model(imgs)
+    unfused = timed(lambda: model(imgs), opt.repeats)
+    model.fuse()
+    outputs = model(imgs)
+    fused = timed(lambda: model(imgs), opt.repeats)
+
+    difference = (outputs - expected).abs()
+    detections = model.detect(imgs, opt.conf_thres, opt.nms_thres)
+    print("Batch %d, %d px" % (opt.batch_size, opt.img_size))
+    print("Conv + BatchNorm:  %.0f ms" % (1000 * unfused))
+    print("Fused convolution: %.0f ms (%.2fx)" % (1000 * fused, unfused / fused))
+    print("Output difference: max %.2e, mean %.2e (allclose: %s)" % (
+        difference.max().item(), difference.mean().item(), torch.allclose(outputs, expected, rtol=1e-4, atol=1e-3)))
+    print("Detections after fusing: %s" % [0 if d is None else len(d) for d in detections])
+
+
+def matched_detections(expected, outputs):
+    """
+    Number of 'expected' detections with a close one among 'outputs', and number of 'expected' detections.
+    Near equal confidences (common with random weights) may be ordered differently and change what NMS keeps
+    """
+    matched = total = 0
+    for a, b in zip(expected, outputs):
+        if a is not None:
+            total += len(a)
+            if b is not None:
+                # The matrix product path of cdist loses too much precision at pixel coordinates
+                distances = torch.cdist(a, b, compute_mode="donot_use_mm_for_euclid_dist")
+                matched += int((distances.min(1)[0] < 1e-2).sum())
+    return matched, total
+
+
+def check_parity(name, matched, total, minimum=1.0):
+    """ Records a failure if less than 'minimum' of the expected detections were matched """
+    if total and matched < minimum * total:
+        failures.append("%s: %d/%d detections matched, less than %.0f%%" % (name, matched, total, 100 * minimum))
+
+
+def bench_compile(opt):
+    """ Startup time and latency of the eager model against the compiled TorchScript artifact """
+    import tempfile
+    from ObjectDetector.compiled import CompiledDarknet
+
+    weights = existing(opt.weights_path)
+    device = torch.device("cpu")
+    start = time.time()
+    model = load_model(opt.model_def, weights, opt.img_size, device)
+    eager_startup = time.time() - start
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "model.pt")
+        start = time.time()
+        # A copy of the timed model, a second load would get other random weights without a checkpoint
+        CompiledDarknet.compile(copy.deepcopy(model), opt.img_size, device, path)
+        cold_startup = time.time() - start
+        start = time.time()
+        compiled = CompiledDarknet.load(path, device)
+        warm_startup = time.time() - start
+
+    print("Startup: eager %.2f s, compile and cache %.2f s, cached artifact %.2f s" % (eager_startup, cold_startup, warm_startup))
+    for batch_size in sorted(set([1, opt.batch_size])):
+        imgs = torch.rand(batch_size, 3, opt.img_size, opt.img_size)
+        eager = timed(lambda: model(imgs), opt.repeats)
+        fast = timed(lambda: compiled(imgs), opt.repeats)
+        difference = (compiled(imgs) - model(imgs)).abs().max().item()
+        matched, total = matched_detections(
+            model.detect(imgs, opt.conf_thres, opt.nms_thres), compiled.detect(imgs, opt.conf_thres, opt.nms_thres)
+        )
+        check_parity("compiled, batch %d" % batch_size, matched, total, 0.99)
+        print(
+            "batch %d, %d px: eager %.0f ms, compiled %.0f ms (%.2fx), max output difference %.1e, %d/%d detections matched"
+            % (batch_size, opt.img_size, 1000 * eager, 1000 * fast, eager / fast, difference, matched, total)
+        )
+
+
+def bench_backends(opt):
+    """ Throughput and detection parity of every backend against eager torch, at batch sizes 1, 4 and 8 """
+    import tempfile
+    from ObjectDetector.backends import OnnxRuntimeBackend, export_onnx
+    from ObjectDetector.compiled import CompiledDarknet
+
+    model = load_model(opt.model_def, existing(opt.weights_path), opt.img_size, torch.device("cpu"))
+    with tempfile.TemporaryDirectory() as directory:
+        path = export_onnx(model, os.path.join(directory, "model.onnx"), opt.img_size)
+        runtimes = [
+            ("torch", model),
+            ("torchscript", CompiledDarknet.compile(model, opt.img_size, torch.device("cpu"))),
+            ("onnxruntime", OnnxRuntimeBackend(path, opt.img_size)),
+        ]
+
+    for batch_size in (1, 4, 8):
+        imgs = torch.rand(batch_size, 3, opt.img_size, opt.img_size)
+        expected = model(imgs)
+        expected_detections = model.detect(imgs, opt.conf_thres, opt.nms_thres)
+        for name, runtime in runtimes:
+            elapsed = timed(lambda: runtime.detect(imgs, opt.conf_thres, opt.nms_thres), opt.repeats)
+            difference = (runtime(imgs) - expected).abs().max().item()
+            matched, total = matched_detections(expected_detections, runtime.detect(imgs, opt.conf_thres, opt.nms_thres))
+            # Eager torch must find its own detections, other runtimes may reorder near equal confidences
+            check_parity("%s, batch %d" % (name, batch_size), matched, total, 1.0 if runtime is model else 0.99)
+            print(
+                "batch %d, %-11s: %5.1f fps (%.0f ms), max output difference %.1e, %d/%d detections matched"
+                % (batch_size, name, batch_size / elapsed, 1000 * elapsed, difference, matched, total)
+            )
+
+
+def bench_int8(opt):
+    """ Latency and output drift of the int8 model, calibrated on random images (quantize.py calibrates on real ones) """
+    from ObjectDetector.quantization import quantize_model
+
+    model = load_model(opt.model_def, existing(opt.weights_path), opt.img_size, torch.device("cpu"), fuse=False)
+    int8_model = quantize_model(model, [torch.rand(2, 3, opt.img_size, opt.img_size) for _ in range(4)])
+    model.fuse()
+    for batch_size in sorted(set([1, opt.batch_size])):
+        imgs = torch.rand(batch_size, 3, opt.img_size, opt.img_size)
+        fp32 = timed(lambda: model(imgs), opt.repeats)
+        int8 = timed(lambda: int8_model(imgs), opt.repeats)
+        drift = (int8_model(imgs)[..., 4:] - model(imgs)[..., 4:]).abs().max().item()
+        print(
+            "batch %d, %d px: fp32 %.0f ms, int8 %.0f ms (%.2fx), max confidence drift %.3f"
+            % (batch_size, opt.img_size, 1000 * fp32, 1000 * int8, fp32 / int8, drift)
+        )
+
+
+def load_stats(model_def, path, img_size):
+    """ Load time, added RSS and added private memory of a model in a fresh process, after one inference """
+    torch.set_grad_enabled(False)
+    base_rss, base_private = rss_bytes(), anonymous_bytes()
+    start = time.time()
+    model = load_model(model_def, path, img_size, torch.device("cpu"))
+    elapsed = time.time() - start
+    model(torch.rand(1, 3, img_size, img_size))
+    return elapsed, rss_bytes() - base_rss, anonymous_bytes() - base_private
+
+
+def bench_package(opt):
+    """ Cold start time and private memory of a model loaded from .weights, .pth and a memory mapped package """
+    import multiprocessing
+    import tempfile
+    from ObjectDetector.model_package import save_package
+
+    with tempfile.TemporaryDirectory() as directory:
+        model = load_model(opt.model_def, existing(opt.weights_path), opt.img_size, torch.device("cpu"), fuse=False)
+        paths = [os.path.join(directory, "model.weights"), os.path.join(directory, "model.pth")]
+        model.save_darknet_weights(paths[0])
+        torch.save(model.state_dict(), paths[1])
+        paths.append(save_package(model.fuse(), os.path.join(directory, "model.pack")))
+        del model
+
+        # Every load in a new process, as a worker starting up would
+        with multiprocessing.get_context("spawn").Pool(1, maxtasksperchild=1) as pool:
+            for path in paths:
+                elapsed, rss, private = pool.apply(load_stats, (opt.model_def, path, opt.img_size))
+                print(
+                    "%-13s load %4.0f ms, +%6.1f MB RSS, +%6.1f MB private memory"
+                    % (os.path.basename(path), 1000 * elapsed, rss / 2 ** 20, private / 2 ** 20)
+                )
+        print("Package pages are shared through the page cache by every process that maps the same file")
+
+
+def bench_tiling(opt):
+    """ Cost of adding full resolution tiles to a detector run, by number of active tiles """
+    import numpy as np
+    from av import VideoFrame
+    from ObjectDetector.deteccion_video import infer_batch
+    from ObjectDetector.utils.preprocess import FramePreprocessor
+    from ObjectDetector.utils.tiling import FrameTiler
+
+    width, height = opt.frame_width, opt.frame_height
+    frame = VideoFrame.from_ndarray(np.random.randint(0, 255, (height, width, 3), dtype=np.uint8), format="rgb24")
+    model = load_model(opt.model_def, existing(opt.weights_path), opt.img_size, torch.device("cpu"))
+    preprocess = FramePreprocessor(img_size=opt.img_size)
+    tiler = FrameTiler(img_size=opt.img_size)
+    tiler.layout(width, height)
+    print(
+        "%dx%d frame: a 20 px part is %.1f px wide in the whole frame input and %.1f px in a tile, %d tiles in the grid"
+        % (width, height, 20 * preprocess.content_w / width, 20 * opt.img_size / tiler.tile_side, len(tiler.grid))
+    )
+
+    class Activity(object):
+        box = [0, 0, 720, 540]  # A track covering the whole frame makes every tile active
+
+    for max_tiles in range(0, min(len(tiler.grid), 4) + 1):
+        tiler.max_tiles = max_tiles
+
+        def run():
+            imgs, _ = preprocess(frame)
+            if max_tiles:
+                tiles, _ = tiler(frame, [Activity()])
+                imgs = torch.cat([imgs, tiles], 0)
+            return infer_batch(model, [(imgs, None)])
+
+        print("%d tiles: %.0f ms per detector run" % (max_tiles, 1000 * timed(run, opt.repeats)))
+
+
+def bench_precision(opt):
+    """ Throughput and output drift of bf16 autocast against fp32 (test.py --precision compares the AP) """
+    model = load_model(opt.model_def, existing(opt.weights_path), opt.img_size, torch.device("cpu"))
+    for batch_size in sorted(set([1, 4, opt.batch_size])):
+        imgs = torch.rand(batch_size, 3, opt.img_size, opt.img_size)
+        model.precision = "fp32"
+        expected = model(imgs)
+        expected_detections = model.detect(imgs, opt.conf_thres, opt.nms_thres)
+        fp32 = timed(lambda: model(imgs), opt.repeats)
+        model.precision = "bf16"
+        outputs = model(imgs)
+        bf16 = timed(lambda: model(imgs), opt.repeats)
+        matched, total = matched_detections(expected_detections, model.detect(imgs, opt.conf_thres, opt.nms_thres))
+        # bf16 drift is enough to reorder the near equal confidences of random weights
+        check_parity("bf16, batch %d" % batch_size, matched, total, 0.95)
+        print(
+            "batch %d, %d px: fp32 %.1f fps, bf16 %.1f fps (%.2fx), max box drift %.1e px, max confidence drift %.1e, "
+            "%d/%d detections matched"
+            % (
+                batch_size,
+                opt.img_size,
+                batch_size / fp32,
+                batch_size / bf16,
+                fp32 / bf16,
+                (outputs[..., :4] - expected[..., :4]).abs().max().item(),
+                (outputs[..., 4:] - expected[..., 4:]).abs().max().item(),
+                matched,
+                total,
+            )
+        )
+
+
+benchmarks = {
+    "registry": bench_registry,
+    "batching": bench_batching,
+    "preprocess": bench_preprocess,
+    "nms": bench_nms,
+    "activations": bench_activations,
+    "fuse": bench_fuse,
+    "compile": bench_compile,
+    "backends": bench_backends,
+    "int8": bench_int8,
+    "package": bench_package,
+    "tiling": bench_tiling,
+    "precision": bench_precision,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=sorted(benchmarks), help="benchmark to run")
+    parser.add_argument("--model_def", type=str, default=model_def, help="path to model definition file")
+    parser.add_argument("--weights_path", type=str, default=weights_path, help="path to weights file")
+    parser.add_argument("--img_size", type=int, default=416, help="size of each image dimension")
+    parser.add_argument("--sessions", type=int, default=4, help="number of simulated sessions")
+    parser.add_argument("--frame_width", type=int, default=1920, help="width of the simulated camera frames")
+    parser.add_argument("--frame_height", type=int, default=1080, help="height of the simulated camera frames")
+    parser.add_argument("--batch_size", type=int, default=1, help="size of the batches")
+    parser.add_argument("--conf_thres", type=float, default=0.001, help="object confidence threshold")
+    parser.add_argument("--nms_thres", type=float, default=0.4, help="iou thresshold for non-maximum suppression")
+    parser.add_argument("--repeats", type=int, default=5, help="timed repetitions of each measurement")
+    opt = parser.parse_args()
+    print(opt)
+
+    torch.set_grad_enabled(False)
+    benchmarks[opt.benchmark](opt)
+    for failure in failures:
+        print("FAILED %s" % failure)
+    sys.exit(1 if failures else 0)
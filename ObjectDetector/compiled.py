@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import warnings
+
+import torch
+
+from ObjectDetector.utils.utils import non_max_suppression
+
+# Where compiled and exported models are stored, one file per key. Absolute, so the scripts
+# run from ObjectDetector/ and the server run from the repository root share it
+cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "weights", "compiled")
+
+
+def artifact_key(model_def, weights_path, img_size, device):
+    """
+    Hash identifying a compiled model: contents of the cfg, weights file (path, size and
+    modification time, to avoid reading hundreds of MB on every start), input size,
+    device type and torch version, since artifacts are not portable across releases
+    """
+    digest = hashlib.sha1()
+    with open(model_def, "rb") as f:
+        digest.update(f.read())
+    if weights_path is not None:
+        stat = os.stat(weights_path)
+        digest.update(("%s:%d:%d" % (os.path.abspath(weights_path), stat.st_size, stat.st_mtime_ns)).encode())
+    digest.update(("%d:%s:%s" % (int(img_size), torch.device(device).type, torch.__version__)).encode())
+    return digest.hexdigest()
+
+
+def artifact_path(model_def, weights_path, img_size, device, extension=".pt", directory=cache_dir):
+    name = "%s-%d-%s%s" % (
+        os.path.splitext(os.path.basename(model_def))[0],
+        int(img_size),
+        artifact_key(model_def, weights_path, img_size, device)[:16],
+        extension,
+    )
+    return os.path.join(directory, name)
+
+
+def optimize(module):
+    """
+    Device specific graph rewrites of a frozen module. They can not be serialized, so
+    artifacts are stored frozen and optimized every time they are loaded
+    """
+    if not hasattr(torch.jit, "optimize_for_inference"):
+        return module
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return torch.jit.optimize_for_inference(module)
+
+
+class CompiledDarknet(object):
+    """
+    Darknet traced for a fixed input size, frozen and optimized for inference.
+    The layer graph is resolved once at compile time, so no module_defs are interpreted
+    per frame. Calling it returns the dense (samples, boxes, 5 + classes) output of the
+    eval-mode Darknet and detect() matches Darknet.detect(). Any batch size is accepted.
+    """
+
+    def __init__(self, module, img_size, device, nbytes):
+        self.module = module
+        self.img_size = img_size
+        self.device = torch.device(device)
+        self.nbytes = nbytes  # Size of the weights baked into the module
+
+    @classmethod
+    def compile(cls, model, img_size, device, path=None):
+        """ Compiles the eval-mode, fused 'model' and saves it to 'path' if given """
+        device = torch.device(device)
+        # From the state dict, which also holds the weights of quantized modules
+        nbytes = sum(t.numel() * t.element_size() for t in model.state_dict().values() if torch.is_tensor(t))
+        example = torch.rand(1, 3, img_size, img_size, device=device)
+        with torch.no_grad(), warnings.catch_warnings():
+            # Deprecation notices of torch.jit and the anchors registered as trace constants
+            warnings.simplefilter("ignore")
+            module = torch.jit.freeze(torch.jit.trace(model, example, check_trace=False).eval())
+            if path is not None:
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                meta = {"img_size": img_size, "nbytes": nbytes}
+                torch.jit.save(module, path, _extra_files={"meta.json": json.dumps(meta)})
+        return cls(optimize(module), img_size, device, nbytes)
+
+    @classmethod
+    def load(cls, path, device):
+        extra_files = {"meta.json": ""}
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+        meta = json.loads(extra_files["meta.json"])
+        return cls(optimize(module), meta["img_size"], device, meta["nbytes"])
+
+    def __call__(self, imgs):
+        if imgs.shape[2:] != (self.img_size, self.img_size):
+            raise ValueError("Compiled for %d px inputs, got %s" % (self.img_size, tuple(imgs.shape[2:])))
+        return self.module(imgs)
+
+    def detect(self, imgs, conf_thres, nms_thres):
+        """ Inference followed by Non-Maximum Suppression. Returns the detections of each image """
+        return non_max_suppression(self(imgs).cpu(), conf_thres, nms_thres)
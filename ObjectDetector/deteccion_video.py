@@ -2,7 +2,16 @@ from __future__ import division
 from ObjectDetector.models import *
 from ObjectDetector.utils.utils import *
 from ObjectDetector.utils.datasets import *
+from ObjectDetector.model_registry import model_registry
+from ObjectDetector.backends import model_device
+from ObjectDetector.inference import InferenceSlot, acquire_scheduler
+from ObjectDetector.utils.preprocess import FramePreprocessor
+from ObjectDetector.utils.motion import MotionGate
+from ObjectDetector.utils.tracker import IoUTracker
+from ObjectDetector.utils.resolution import ResolutionController
+from ObjectDetector.utils.tiling import FrameTiler
 import cv2
+import functools
 import torch
 from torch.autograd import Variable
 import numpy as np
@@ -20,6 +29,44 @@ batch_size          = 1                                              # size of t
 n_cpu               = 0                                              # number of cpu threads to use during batch generation
 img_size            = 416                                            # size of each image dimension
 checkpoint_model    = "ObjectDetector/weights/yolov3_ckpt_499.pth"   # path to checkpoint model
+frame_size          = (720, 540)                                     # frame geometry before letterboxing
+motion_thres        = 0.02                                           # mean frame change below which detections are reused
+detect_interval     = 5                                              # run the detector every N frames, track in between
+confirm_frames      = 30                                             # frames a single tracked object needs to be announced
+confirm_hits        = 3                                              # detector runs that must find it as well, the motion gate
+                                                                     # does not skip frames while a track has fewer
+backend             = "torch"                                        # detector runtime: torch, torchscript, onnxruntime or int8.
+                                                                     # Stays on torch, like detect.py and test.py: the other runtimes
+                                                                     # load an artifact compiled for img_size only, so the resolution
+                                                                     # ladder could not change the input size. torchscript loads the
+                                                                     # cached compiled.py artifact where a fixed size is enough
+precision           = "fp32"                                         # torch backend precision: fp32, or bf16 for CPUs with bf16 units
+resolution_ladder   = (288, 320, 416, 512)                           # input sizes chosen from latency and backlog (torch backend only,
+                                                                     # the others are compiled for img_size)
+min_img_size        = 320                                            # smallest input size allowed, whatever the load
+latency_target      = 0.25                                           # seconds from frame submission to detections
+tiled               = False                                          # also detect on full resolution tiles where the previous frame had activity
+tile_side           = 608                                            # frame pixels covered by one tile
+max_tiles           = 4                                              # tiles added to a detector run at most
+cascade             = False                                          # screen every frame with a small model, run the full one to confirm
+screen_model_def    = "ObjectDetector/config/yolov3-tiny-custom.cfg" # path to the screening model definition file
+screen_weights_path = "ObjectDetector/weights/yolov3_tiny_ckpt.pth"  # path to the screening weights, see train.py --teacher_weights
+screen_conf_thres   = 0.5                                            # screening detections between this and conf_thres are uncertain
+
+def infer_batch(model, jobs, conf_thres=conf_thres):
+    # Executed on an inference thread, never on the event loop.
+    # Stacks the frames of several sessions into one forward pass and splits the detections back per job
+    device = model_device(model)
+    imgs = torch.cat([imgTensor for imgTensor, _ in jobs], 0).to(device)
+    with torch.no_grad():
+        detections = model.detect(imgs, conf_thres, nms_thres)
+
+    results = []
+    start = 0
+    for imgTensor, _ in jobs:
+        results.append(detections[start : start + imgTensor.size(0)])
+        start += imgTensor.size(0)
+    return results
 
 def Convert_RGB(img):
     # Convert Blue, green, red into Red, green, blue
@@ -53,20 +100,52 @@ class DetectionVideo(MediaStreamTrack):
         # Choose device for training: cuda if it is available, cpu if not
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         print("cuda" if torch.cuda.is_available() else "cpu")
-        self.model = Darknet(model_def, img_size=img_size).to(device) # Create model
 
-        # Upload weights of model
-        if weights_path.endswith(".weights"):
-            self.model.load_darknet_weights(weights_path)
-        else:
-            self.model.load_state_dict(torch.load(weights_path))
+        # The model is loaded once per process and shared by every session
+        self.model_handle = model_registry.acquire(model_def, weights_path, img_size=img_size, device=device, backend=backend, precision=precision)
+        self.model = self.model_handle.model
+        print(model_registry.format_memory_report())
 
-        self.model.eval() # Evaluate model
         self.classes = load_classes(class_path) # Upload classes to detect
-        self.Tensor = torch.cuda.FloatTensor if torch.cuda.is_available() else torch.FloatTensor
 
         self.detect = False
         self.objs = set()
+        self.data_channel = None
+
+        # Frames of every session using this model are batched together by one scheduler.
+        # Each session keeps at most one frame waiting, newer frames replace the waiting one
+        scheduler = acquire_scheduler(self.model_handle.key, functools.partial(infer_batch, self.model))
+        self.inference = InferenceSlot(scheduler, self.handle_detections, self.discard_job)
+
+        # In cascade mode a small model screens every frame and only frames it is unsure about, or
+        # where it sees a class not tracked yet, go to the full model
+        self.screen_handle = None
+        models = [self.model]
+        if cascade:
+            self.screen_handle = model_registry.acquire(screen_model_def, screen_weights_path, img_size=img_size, device=device, backend=backend, precision=precision)
+            self.screen_model = self.screen_handle.model
+            screen_scheduler = acquire_scheduler(
+                self.screen_handle.key, functools.partial(infer_batch, self.screen_model, conf_thres=screen_conf_thres)
+            )
+            self.screen_inference = InferenceSlot(screen_scheduler, self.handle_screen_detections, self.discard_job)
+            models.append(self.screen_model)
+        self.escalations = {"new_class": 0, "uncertain": 0}
+
+        # Input size follows the detection latency and backlog, one preprocessor per size
+        ladder = resolution_ladder if all(isinstance(model, torch.nn.Module) for model in models) else (img_size,)
+        self.resolution = ResolutionController(ladder, start=img_size, min_size=min_img_size, target_latency=latency_target)
+        self.preprocessors = {}
+        self.tilers = {}
+
+        # Frames that barely changed since the last inferred one are not sent to the detector
+        self.motion = MotionGate(threshold=motion_thres)
+
+        # Objects are followed by the tracker on every frame, the detector only refreshes it
+        self.tracker = IoUTracker()
+        self.frames = 0
+        self.frames_since_detection = detect_interval
+        self.detection_requested = False
+        self.detector_runs = 0
 
         self.single_detection = {
             "object": None,
@@ -84,9 +163,48 @@ class DetectionVideo(MediaStreamTrack):
                     print(message)
                     if message == "start detection":
                         self.detect = True
+                        self.detection_requested = True
                     elif message == "stop detection":
                         self.detect = False
 
+    def stop(self):
+        super().stop()
+        self.inference.close()
+        if self.screen_handle is not None:
+            self.screen_inference.close()
+            self.screen_handle.release()
+            self.screen_handle = None
+        # Give the shared model back to the registry, it is freed with the last session
+        if self.model_handle is not None:
+            self.model_handle.release()
+            self.model_handle = None
+            print(model_registry.format_memory_report())
+
+    def metrics(self):
+        metrics = self.inference.metrics()
+        metrics.update(self.motion.metrics())
+        metrics.update(self.resolution.metrics())
+        if tiled:
+            runs = sum(tiler.frames for tiler in self.tilers.values())
+            metrics["tiles_per_run"] = sum(tiler.tiles for tiler in self.tilers.values()) / runs if runs else 0.0
+        metrics["frames"] = self.frames
+        metrics["detector_runs"] = self.detector_runs
+        metrics["tracks"] = len(self.tracker.tracks)
+        # Estimated detector time not spent thanks to tracking and skipped frames
+        metrics["cpu_saved_s"] = (self.frames - self.detector_runs) * metrics["batch_job_ms"] / 1000
+        if cascade:
+            metrics.update(("screen_" + name, value) for name, value in self.screen_inference.metrics().items())
+            metrics.update(("escalations_" + reason, count) for reason, count in self.escalations.items())
+            metrics["screen_rate"] = self.screen_inference.submitted / self.frames if self.frames else 0.0
+            metrics["confirm_rate"] = self.inference.submitted / self.frames if self.frames else 0.0
+            # Full model time not spent on the frames only the small model looked at, minus the time of the small model
+            # (a lower bound until the full model has run once and its job time is known)
+            metrics["cpu_saved_s"] = (
+                (self.frames - self.inference.submitted) * metrics["batch_job_ms"]
+                - self.screen_inference.submitted * metrics["screen_batch_job_ms"]
+            ) / 1000
+        return metrics
+
     def add_to_set(self, x):
         # Return True if added to set and False if not
         return len(self.objs) != (self.objs.add(x) or len(self.objs))
@@ -94,55 +212,121 @@ class DetectionVideo(MediaStreamTrack):
     # Object detector program
     async def recv(self):
         frame = await self.track.recv()
-        res = (720,540)
-        
-        frame = frame.to_ndarray(format="bgr24")
-        
-        frame = cv2.resize(frame, res, interpolation=cv2.INTER_CUBIC)
-
-        # The image is BGR and it has to be converted into RGB
-        RGBimg = Convert_RGB(frame)
-        imgTensor = transforms.ToTensor()(RGBimg)
-        imgTensor, _ = pad_to_square(imgTensor, 0)
-        imgTensor = resize(imgTensor, 416)
-        imgTensor = imgTensor.unsqueeze(0)
-        imgTensor = Variable(imgTensor.type(self.Tensor))
-
-        # Obtain detections
-        with torch.no_grad():
-            detections = self.model(imgTensor)
-            detections = non_max_suppression(detections, conf_thres, nms_thres)
-
-        # For each detection, coordinates are taken and object is marked with a rectangle.
+        self.frames += 1
+
+        # Tracks follow the objects on every frame, the detector only runs every few frames
+        self.tracker.predict()
+        self.frames_since_detection += 1
+        if cascade or self.detection_requested or self.frames_since_detection >= detect_interval:
+            # Frames that barely changed since the last inferred one are not worth a detector run,
+            # unless a track still has to be confirmed (or dropped, if it was a false positive)
+            unconfirmed = any(track.hits < confirm_hits for track in self.tracker.tracks)
+            if self.motion.should_infer(frame, force=self.detection_requested or unconfirmed):
+                requested = self.detection_requested
+                self.detection_requested = False
+                self.frames_since_detection = 0
+                self.detector_runs += 1
+
+                # Single pass from the decoded frame to the letterboxed input tensor
+                size = self.resolution.size
+                imgTensor, letterbox = self.preprocessor(size)(frame)
+                letterboxes = [letterbox]
+
+                if tiled and self.tiler(size).enabled(frame):
+                    tiles, tile_letterboxes = self.tiler(size)(frame, self.tracker.tracks, self.motion.difference)
+                    if tiles is not None:
+                        # Whole frame and active tiles go through the detector in one forward pass
+                        imgs = torch.cat([imgTensor, tiles], 0)
+                        self.preprocessor(size).release(imgTensor)
+                        imgTensor, letterboxes = imgs, letterboxes + tile_letterboxes
+
+                # Inference runs on the executor, results come back through handle_detections.
+                # A requested detection skips the screening model
+                if cascade and not requested:
+                    self.screen_inference.submit((imgTensor, letterboxes))
+                else:
+                    self.inference.submit((imgTensor, letterboxes))
+
+        self.update_objects()
+
+    def preprocessor(self, size):
+        preprocess = self.preprocessors.get(size)
+        if preprocess is None:
+            preprocess = self.preprocessors[size] = FramePreprocessor(img_size=size, frame_size=frame_size)
+        return preprocess
+
+    def tiler(self, size):
+        tiler = self.tilers.get(size)
+        if tiler is None:
+            tiler = self.tilers[size] = FrameTiler(
+                img_size=size, frame_size=frame_size, tile_side=tile_side, max_tiles=max_tiles, motion_thres=motion_thres
+            )
+        return tiler
+
+    def discard_job(self, job):
+        # Frame dropped before inference, its input buffer can be reused
+        self.preprocessor(job[0].size(-1)).release(job[0])
+
+    def handle_detections(self, job, detections):
+        imgTensor, _ = job
+        self.preprocessor(imgTensor.size(-1)).release(imgTensor)
+        if not cascade:
+            # Full batches of frames waiting for the shared detector count as backlog
+            self.resolution.observe(self.inference.last_latency, self.inference.scheduler.backlog())
+        self.tracker.update(self.frame_detections(job, detections))
+
+    def handle_screen_detections(self, job, detections):
+        # The screening model runs on every frame, its latency sets the input size
+        self.resolution.observe(self.screen_inference.last_latency, self.screen_inference.scheduler.backlog())
+        detections = self.frame_detections(job, detections)
+        tracked = set(track.cls_pred for track in self.tracker.tracks)
+        escalate = None
         for detection in detections:
-            if detection is not None:
-                detection = rescale_boxes(detection, img_size, RGBimg.shape[:2])
-                for x1, y1, x2, y2, conf, cls_conf, cls_pred in detection:
-                    if self.detect and self.data_channel is not None:
-                        if self.add_to_set(self.classes[int(cls_pred)]):
-                            self.data_channel.send(self.classes[int(cls_pred)])
-                    elif detection.size(dim=0) == 1:
-                        if self.single_detection["object"] == self.classes[int(cls_pred)]:
-                            self.single_detection["num"] += 1
-                        else:
-                            self.single_detection["object"] = self.classes[int(cls_pred)]
-                            self.single_detection["num"] = 1
-                    else:
-                        self.single_detection["object"] = None
-                        self.single_detection["num"] = 0
-                    
-                    if self.single_detection["num"] == 30 and self.data_channel is not None:
-                        self.data_channel.send(self.classes[int(cls_pred)])
-                        print("{} was detected in X1: {}, Y1: {}, X2: {}, Y2: {}, with a certainty of {}.".format(self.classes[int(cls_pred)], x1, y1, x2, y2, conf))
-
-                #     box_w = x2 - x1
-                #     box_h = y2 - y1
-                #     color = [int(c) for c in self.colors[int(cls_pred)]]
-                #     print("{} was detected in X1: {}, Y1: {}, X2: {}, Y2: {}, with a certainty of {}.".format(self.classes[int(cls_pred)], x1, y1, x2, y2, conf))
-                #     frame = cv2.rectangle(frame, (x1, y1 + box_h), (x2, y1), color, 5)
-                #     cv2.putText(frame, self.classes[int(cls_pred)], (x1, y1), cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2)# Nombre de la clase detectada
-                #     cv2.putText(frame, str("%.2f" % float(conf)), (x2, y2 - box_h), cv2.FONT_HERSHEY_SIMPLEX, 0.5,color, 2) # Certeza de prediccion de la clase
-                
-                # cv2.imshow('frame', Convert_BGR(RGBimg))
-                # if cv2.waitKey(25) & 0xFF == ord('q'):
-                #     break
+            for x1, y1, x2, y2, conf, cls_conf, cls_pred in detection.tolist() if detection is not None else []:
+                if int(cls_pred) not in tracked:
+                    escalate = "new_class"
+                elif conf < conf_thres and escalate is None:
+                    escalate = "uncertain"
+        if escalate is not None:
+            # The same input goes to the full model, whose detections update the tracker
+            self.escalations[escalate] += 1
+            self.inference.submit(job)
+            return
+        imgTensor, _ = job
+        self.preprocessor(imgTensor.size(-1)).release(imgTensor)
+        self.tracker.update(detections)
+
+    def frame_detections(self, job, detections):
+        # Detections of the whole frame and its tiles in frame coordinates
+        _, letterboxes = job
+        detections = [
+            rescale_letterbox_boxes(detection, letterbox)
+            for detection, letterbox in zip(detections, letterboxes)
+            if detection is not None
+        ]
+        if len(letterboxes) > 1:
+            # Tiles overlap each other and the whole frame, the same object may be found several times
+            detections = [merge_detections(detections, nms_thres)]
+        return detections
+
+    def update_objects(self):
+        # Confirmation is based on how many frames the tracked objects have been followed, and how
+        # many detector runs found them so a single false positive is never announced
+        tracks = self.tracker.tracks
+        if self.detect and self.data_channel is not None:
+            for track in tracks:
+                if self.add_to_set(self.classes[track.cls_pred]):
+                    self.data_channel.send(self.classes[track.cls_pred])
+        elif len(tracks) == 1:
+            track = tracks[0]
+            self.single_detection["object"] = self.classes[track.cls_pred]
+            self.single_detection["num"] = track.age
+
+            if track.age >= confirm_frames and track.hits >= confirm_hits and not track.announced and self.data_channel is not None:
+                track.announced = True
+                self.data_channel.send(self.classes[track.cls_pred])
+                x1, y1, x2, y2 = track.box
+                print("{} was detected in X1: {}, Y1: {}, X2: {}, Y2: {}, with a certainty of {}.".format(self.classes[track.cls_pred], x1, y1, x2, y2, track.conf))
+        elif len(tracks) > 1:
+            self.single_detection["object"] = None
+            self.single_detection["num"] = 0
@@ -1,6 +1,8 @@
 from __future__ import division
 
 from models import *
+from model_registry import load_model
+from backends import backends, precisions
 from utils.utils import *
 from utils.datasets import *
 
@@ -33,6 +35,8 @@ if __name__ == "__main__":
     parser.add_argument("--n_cpu", type=int, default=1, help="number of cpu threads to use during batch generation")
     parser.add_argument("--img_size", type=int, default=416, help="size of each image dimension")
     parser.add_argument("--checkpoint_model", type=str, help="path to checkpoint model")
+    parser.add_argument("--backend", type=str, default="torch", choices=backends, help="runtime of the detector")
+    parser.add_argument("--precision", type=str, default="fp32", choices=precisions, help="precision of the torch backend")
     opt = parser.parse_args()
     print(opt)
 
@@ -40,17 +44,8 @@ if __name__ == "__main__":
 
     os.makedirs("output", exist_ok=True)
 
-    # Set up model
-    model = Darknet(opt.model_def, img_size=opt.img_size).to(device)
-
-    if opt.weights_path.endswith(".weights"):
-        # Load darknet weights
-        model.load_darknet_weights(opt.weights_path)
-    else:
-        # Load checkpoint weights
-        model.load_state_dict(torch.load(opt.weights_path))
-
-    model.eval()  # Set in evaluation mode
+    # Set up model: weights loaded, batch norms folded, evaluation mode and converted for the backend
+    model = load_model(opt.model_def, opt.weights_path, opt.img_size, device, backend=opt.backend, precision=opt.precision)
 
     dataloader = DataLoader(
         ImageFolder(opt.image_folder, img_size=opt.img_size),
@@ -76,8 +71,7 @@ if __name__ == "__main__":
 
         # Get detections
         with torch.no_grad():
-            detections = model(input_imgs)
-            detections = non_max_suppression(detections, opt.conf_thres, opt.nms_thres)
+            detections = model.detect(input_imgs, opt.conf_thres, opt.nms_thres)
 
         # Log progress
         current_time = time.time()
@@ -0,0 +1,67 @@
+import functools
+
+import torch
+import torch.nn.functional as F
+
+
+class HeadOutputs(object):
+    """
+    Collects the raw (logit) input of every YOLO layer of a Darknet during its forward passes,
+    and the anchors of that layer, keyed by grid size. Works the same in training and in eval
+    mode, where YOLO layers decode through inference(), since it hooks the convolution in front
+    of each of them
+    """
+
+    def __init__(self, model):
+        self.outputs = {}
+        self.anchors = {}
+        self.hooks = [model.register_forward_pre_hook(self.clear)]
+        for i, module_def in enumerate(model.module_defs):
+            if module_def["type"] == "yolo":
+                collect = functools.partial(self.collect, model.module_list[i][0].anchors)
+                self.hooks.append(model.module_list[i - 1].register_forward_hook(collect))
+
+    def clear(self, module, inputs):
+        # Grid sizes change with multi-scale training
+        self.outputs = {}
+
+    def collect(self, anchors, module, inputs, output):
+        self.outputs[output.size(2)] = output
+        self.anchors[output.size(2)] = [tuple(anchor) for anchor in anchors]
+
+    def remove(self):
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+
+
+def distillation_loss(student, teacher, num_anchors=3):
+    """
+    Soft target loss of the YOLO heads of a student on those of a teacher, both HeadOutputs
+    of the same images. Heads are matched by grid size, so a tiny student with 13 and 26 cell
+    grids learns from the first two heads of the full model, and must use the same anchors on
+    them since predictions are compared anchor by anchor. Objectness is distilled on every cell
+    and anchor, class scores on the cells the teacher finds objects in, weighted by its
+    objectness. Boxes are left to the ground truth loss
+    """
+    grid_sizes = sorted(set(student.outputs) & set(teacher.outputs))
+    if not grid_sizes:
+        raise ValueError("The student and teacher share no YOLO grid size")
+    loss = 0
+    for grid_size in grid_sizes:
+        if student.anchors[grid_size] != teacher.anchors[grid_size]:
+            raise ValueError(
+                "The student and teacher use different anchors on the %d cell grid: %s and %s"
+                % (grid_size, student.anchors[grid_size], teacher.anchors[grid_size])
+            )
+        num_samples = student.outputs[grid_size].size(0)
+        s = student.outputs[grid_size].view(num_samples, num_anchors, -1, grid_size, grid_size)
+        t = teacher.outputs[grid_size].detach().float().view(num_samples, num_anchors, -1, grid_size, grid_size)
+        if s.size(2) != t.size(2):
+            raise ValueError("The student and teacher detect a different number of classes")
+        t_conf = torch.sigmoid(t[:, :, 4])
+        loss_conf = F.binary_cross_entropy_with_logits(s[:, :, 4], t_conf)
+        loss_cls = F.binary_cross_entropy_with_logits(s[:, :, 5:], torch.sigmoid(t[:, :, 5:]), reduction="none")
+        loss_cls = (loss_cls.mean(2) * t_conf).sum() / (t_conf.sum() + 1e-16)
+        loss = loss + loss_conf + loss_cls
+    return loss
@@ -0,0 +1,28 @@
+from __future__ import division
+
+from model_registry import load_model
+from backends import export_onnx, OnnxRuntimeBackend
+
+import argparse
+
+import torch
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_def", type=str, default="config/yolov3-custom.cfg", help="path to model definition file")
+    parser.add_argument("--weights_path", type=str, default="weights/yolov3_ckpt_499.pth", help="path to weights file")
+    parser.add_argument("--img_size", type=int, default=416, help="size of each image dimension")
+    parser.add_argument("--output", type=str, default="weights/yolov3-custom.onnx", help="path of the exported model")
+    parser.add_argument("--opset_version", type=int, default=12, help="ONNX opset of the exported graph")
+    opt = parser.parse_args()
+    print(opt)
+
+    # Export from the cpu, with batch norms folded and YOLO decoding included in the graph
+    model = load_model(opt.model_def, opt.weights_path, opt.img_size, torch.device("cpu"))
+    export_onnx(model, opt.output, opt.img_size, opt.opset_version)
+
+    # Check the exported graph against the model it comes from
+    imgs = torch.rand(2, 3, opt.img_size, opt.img_size)
+    with torch.no_grad():
+        difference = (OnnxRuntimeBackend(opt.output, opt.img_size)(imgs) - model(imgs)).abs().max().item()
+    print("Exported %s, max output difference with torch: %.2e" % (opt.output, difference))
@@ -0,0 +1,209 @@
+import asyncio
+import collections
+import functools
+import time
+
+from thread_pools import get_pool, run_in_pool
+
+inference_workers = 1  # Threads running model forward passes (torch already uses intra-op threads)
+max_batch_size = 8  # Frames from different sessions stacked into one forward pass
+batch_timeout = 0.005  # Seconds the oldest waiting frame may wait for a batch to fill
+
+schedulers = {}  # Model key -> BatchScheduler shared by the sessions using that model
+
+
+def get_executor():
+    return get_pool("inference", inference_workers)
+
+
+def acquire_scheduler(key, infer_batch):
+    """ Returns the scheduler of model 'key', creating it for the first session """
+    scheduler = schedulers.get(key)
+    if scheduler is None:
+        scheduler = schedulers[key] = BatchScheduler(key, infer_batch)
+    scheduler.sessions += 1
+    return scheduler
+
+
+class BatchScheduler(object):
+    """
+    Collects the pending frames of every session sharing a model and runs them through
+    a single call of 'infer_batch', which receives a list of jobs on the executor and
+    returns one result per job. A batch is launched as soon as 'max_batch_size' jobs are
+    waiting or 'batch_timeout' seconds after the oldest one arrived, whichever is first.
+    Jobs are tuples whose first item is the input tensor and only jobs with the same
+    'batch_key' (by default the input shape without the batch dimension) are stacked together.
+    Every method must be called from the event loop thread.
+    """
+
+    def __init__(self, key, infer_batch, max_batch_size=max_batch_size, batch_timeout=batch_timeout,
+                 batch_key=None, executor=None):
+        self.key = key
+        self.infer_batch = infer_batch
+        self.max_batch_size = max_batch_size
+        self.batch_timeout = batch_timeout
+        self.batch_key = batch_key if batch_key is not None else (lambda job: job[0].shape[1:])
+        self.executor = executor if executor is not None else get_executor()
+        self.pending = collections.OrderedDict()  # slot -> (job, queued time), oldest first
+        self.running = False
+        self.timer = None
+        self.sessions = 0
+
+        self.batches = 0
+        self.batched_jobs = 0
+        self.busy_time = 0.0  # Seconds spent running batches
+
+    def submit(self, slot, job):
+        """ Queues 'job' for 'slot'. Returns the waiting job of the same slot it replaced, if any """
+        replaced = self.pending.pop(slot, None)
+        self.pending[slot] = (job, time.time())
+        self._schedule()
+        return replaced[0] if replaced is not None else None
+
+    def cancel(self, slot):
+        """ Removes the waiting job of 'slot' and returns it, if any """
+        cancelled = self.pending.pop(slot, None)
+        return cancelled[0] if cancelled is not None else None
+
+    def backlog(self):
+        """
+        Full batches waiting for the model. Each session holds at most one waiting frame, so
+        frames filling up the next batch are not a backlog, the wait they cost shows in the latency
+        """
+        return len(self.pending) // self.max_batch_size
+
+    def release(self):
+        self.sessions -= 1
+        if self.sessions <= 0 and schedulers.get(self.key) is self:
+            del schedulers[self.key]
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+    def _schedule(self):
+        if self.running or not self.pending:
+            return
+        if len(self.pending) >= self.max_batch_size:
+            self._launch()
+        elif self.timer is None:
+            oldest = next(iter(self.pending.values()))[1]
+            delay = max(0.0, oldest + self.batch_timeout - time.time())
+            self.timer = asyncio.get_event_loop().call_later(delay, self._launch)
+
+    def _launch(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.running or not self.pending:
+            return
+
+        # Oldest job decides the batch key, later compatible jobs fill the batch
+        batch = []
+        key = None
+        for slot, (job, queued_at) in list(self.pending.items()):
+            if key is None:
+                key = self.batch_key(job)
+            elif self.batch_key(job) != key:
+                continue
+            batch.append((slot, job, queued_at))
+            del self.pending[slot]
+            if len(batch) == self.max_batch_size:
+                break
+
+        self.running = True
+        self.batches += 1
+        self.batched_jobs += len(batch)
+        jobs = [job for _, job, _ in batch]
+        run_in_pool(self.executor, self.infer_batch, (jobs,), functools.partial(self._done, batch))
+
+    def _done(self, batch, results, error, elapsed):
+        self.running = False
+        self.busy_time += elapsed
+        if error is not None:
+            print("Inference failed: %r" % error)
+        for i, (slot, job, queued_at) in enumerate(batch):
+            slot.deliver(job, None if results is None else results[i], queued_at, failed=error is not None)
+        self._schedule()
+
+    def metrics(self):
+        return {
+            "batches": self.batches,
+            "mean_batch_size": self.batched_jobs / self.batches if self.batches else 0.0,
+            "job_ms": 1000 * self.busy_time / self.batched_jobs if self.batched_jobs else 0.0,
+            "waiting": len(self.pending),
+            "sessions": self.sessions,
+        }
+
+
+class InferenceSlot(object):
+    """
+    Per-session handle on a BatchScheduler with latest-frame-wins scheduling.
+    At most one job of the session waits for the next batch; a newer job replaces it
+    and the stale one is counted as dropped. 'on_result' is called back on the event
+    loop with (job, result) and 'on_discard', if given, with every job that will never
+    get a result (replaced, failed or cancelled), so resources attached to it can be reused.
+    """
+
+    def __init__(self, scheduler, on_result, on_discard=None):
+        self.scheduler = scheduler
+        self.on_result = on_result
+        self.on_discard = on_discard
+        self.in_flight = 0
+        self.closed = False
+
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.latency = 0.0  # Moving average of queue + inference time in seconds
+        self.last_latency = 0.0  # Queue + inference time of the last result
+
+    def submit(self, job):
+        if self.closed:
+            return
+        self.submitted += 1
+        replaced = self.scheduler.submit(self, job)
+        if replaced is not None:
+            self.dropped += 1  # Stale frame replaced before it was processed
+            self.discard(replaced)
+        else:
+            self.in_flight += 1
+
+    def discard(self, job):
+        if self.on_discard is not None:
+            self.on_discard(job)
+
+    def deliver(self, job, result, queued_at, failed=False):
+        self.in_flight -= 1
+        if failed:
+            self.failed += 1
+        if self.closed or failed:
+            self.discard(job)
+            return
+        self.completed += 1
+        latency = self.last_latency = time.time() - queued_at
+        self.latency = latency if self.completed == 1 else 0.9 * self.latency + 0.1 * latency
+        self.on_result(job, result)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        cancelled = self.scheduler.cancel(self)
+        if cancelled is not None:
+            self.in_flight -= 1
+            self.dropped += 1
+            self.discard(cancelled)
+        self.scheduler.release()
+
+    def metrics(self):
+        metrics = {
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "in_flight": self.in_flight,
+            "latency_ms": 1000 * self.latency,
+        }
+        metrics.update(("batch_" + name, value) for name, value in self.scheduler.metrics().items())
+        return metrics
@@ -0,0 +1,106 @@
+import json
+import mmap
+import struct
+
+import torch
+
+from ObjectDetector.models import Darknet
+
+# Layout of a model package:
+#   magic (8 bytes) | header length (uint64, little endian) | JSON header | padding | tensor data
+# The header holds the module definitions (hyperparameters block first), the class names,
+# whether the batch norms are already folded and, for every tensor of the state dict, its
+# dtype, shape and offset. Tensor data starts on a page boundary and every tensor on a
+# 64 byte boundary, so each one can be used in place from a memory mapping of the file.
+magic = b"YOLOPKG1"
+page_size = mmap.PAGESIZE
+tensor_alignment = 64
+
+dtypes = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+    "int64": torch.int64,
+    "int32": torch.int32,
+    "uint8": torch.uint8,
+}
+
+
+def align(offset, alignment):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def save_package(model, path, class_names=()):
+    """ Writes the module definitions, 'class_names' and state dict of Darknet 'model' to 'path' """
+    dtype_names = dict((dtype, name) for name, dtype in dtypes.items())
+    tensors = []
+    offset = 0
+    entries = {}
+    for name, tensor in model.state_dict().items():
+        tensor = tensor.detach().cpu().contiguous()
+        offset = align(offset, tensor_alignment)
+        entries[name] = {"dtype": dtype_names[tensor.dtype], "shape": list(tensor.shape), "offset": offset}
+        tensors.append((offset, tensor))
+        offset += tensor.numel() * tensor.element_size()
+
+    header = json.dumps(
+        {
+            "module_defs": [model.hyperparams] + model.module_defs,
+            "classes": list(class_names),
+            "fused": model.fused,
+            "seen": int(model.seen),
+            "tensors": entries,
+        }
+    ).encode()
+    data_start = align(len(magic) + 8 + len(header), page_size)
+
+    with open(path, "wb") as f:
+        f.write(magic)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for offset, tensor in tensors:
+            f.seek(data_start + offset)
+            f.write(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    return path
+
+
+def read_header(path):
+    """ Returns the header of package 'path' and the file offset its tensor data starts at """
+    with open(path, "rb") as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError("%s is not a model package" % path)
+        (length,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(length).decode())
+    return header, align(len(magic) + 8 + length, page_size)
+
+
+def load_package(path, img_size=416):
+    """
+    Builds the Darknet stored in package 'path' without parsing any cfg or initializing any
+    parameter: the model is created on the meta device and its parameters and buffers are
+    then assigned tensors backed by a private (copy on write) memory mapping of the file.
+    Pages are read lazily and shared through the page cache by every process loading the
+    same package, until one of them writes to a tensor. The model is on the cpu
+    """
+    header, data_start = read_header(path)
+    with open(path, "rb") as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    state_dict = {}
+    for name, entry in header["tensors"].items():
+        dtype = dtypes[entry["dtype"]]
+        count = 1
+        for size in entry["shape"]:
+            count *= size
+        tensor = torch.frombuffer(mapping, dtype=dtype, count=count, offset=data_start + entry["offset"]) if count else torch.empty(0, dtype=dtype)
+        state_dict[name] = tensor.view(entry["shape"])
+
+    with torch.device("meta"):
+        model = Darknet(header["module_defs"], img_size=img_size)
+        if header["fused"]:
+            model.fuse()  # Same module structure as the packed model, the math runs on meta tensors
+    model.load_state_dict(state_dict, assign=True)
+    model.seen = header["seen"]
+    model.class_names = header["classes"]
+    model.package_mapping = mapping  # Kept open as long as the model lives
+    return model
@@ -0,0 +1,187 @@
+import os
+import threading
+
+import torch
+
+from ObjectDetector.backends import OnnxRuntimeBackend, backends, export_onnx, precisions
+from ObjectDetector.compiled import CompiledDarknet, artifact_path
+from ObjectDetector.model_package import load_package
+from ObjectDetector.models import Darknet
+
+
+def load_model(model_def, weights_path, img_size=416, device=None, fuse=True, backend="torch", precision="fp32"):
+    """
+    Builds a Darknet from 'model_def', loads 'weights_path' into it and returns it
+    in evaluation mode with gradients disabled, ready to be shared read-only.
+    Weights ending in .pack are a model package, memory mapped instead of copied.
+    With 'fuse' the batch norms are folded into the convolutions.
+    With the "torchscript" or "onnxruntime" 'backend' the fused model is compiled or exported
+    instead, or loaded from the on-disk cache when these inputs were already converted.
+    The "int8" model can only be loaded, quantize.py publishes it once it passes its accuracy check.
+    'precision' "bf16" runs the convolutions of the torch backend under bf16 autocast
+    """
+    if backend not in backends:
+        raise ValueError("Unknown backend '%s', expected one of %s" % (backend, ", ".join(backends)))
+    if precision not in precisions or (precision != "fp32" and backend != "torch"):
+        raise ValueError("Precision '%s' is not available with the %s backend" % (precision, backend))
+    device = torch.device(device) if device is not None else default_device()
+    if backend == "int8":
+        path = int8_path(model_def, weights_path, img_size)
+        if not os.path.exists(path):
+            raise FileNotFoundError("No int8 model published for %s and %s, run quantize.py first" % (model_def, weights_path))
+        return CompiledDarknet.load(path, torch.device("cpu"))
+    if backend != "torch":
+        path = artifact_path(model_def, weights_path, img_size, device, ".pt" if backend == "torchscript" else ".onnx")
+        if os.path.exists(path):
+            return CompiledDarknet.load(path, device) if backend == "torchscript" else OnnxRuntimeBackend(path, img_size)
+        fuse = True
+    if weights_path is not None and weights_path.endswith(".pack"):
+        # Module definitions and parameters come from the memory mapped package, model_def is not parsed
+        model = load_package(weights_path, img_size=img_size).to(device)
+    else:
+        model = Darknet(model_def, img_size=img_size).to(device)
+
+        # Upload weights of model
+        if weights_path is not None:
+            if weights_path.endswith(".weights"):
+                model.load_darknet_weights(weights_path)
+            else:
+                model.load_state_dict(torch.load(weights_path, map_location=device))
+
+    model.eval()
+    if fuse:
+        model.fuse()
+    for param in model.parameters():
+        param.requires_grad_(False)
+    model.precision = precision
+    if backend == "torchscript":
+        return CompiledDarknet.compile(model, img_size, device, path)
+    if backend == "onnxruntime":
+        return OnnxRuntimeBackend(export_onnx(model, path, img_size), img_size)
+    return model
+
+
+def int8_path(model_def, weights_path, img_size):
+    """ Where quantize.py publishes the int8 model of these inputs """
+    return artifact_path(model_def, weights_path, img_size, torch.device("cpu"), ".int8.pt")
+
+
+def default_device():
+    # cuda if it is available, cpu if not
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def model_bytes(model):
+    """ Number of bytes held by the parameters and buffers of 'model' """
+    if not isinstance(model, torch.nn.Module):
+        return model.nbytes  # Compiled or exported model, whose weights are not module parameters
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class ModelHandle(object):
+    """Reference to a shared model. Call release() once the session is done with it"""
+
+    def __init__(self, registry, key, model):
+        self.registry = registry
+        self.key = key
+        self.model = model
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.model = None
+            self.registry.release(self.key)
+
+
+class ModelRegistry(object):
+    """
+    Loads each (model_def, weights_path, img_size, device, backend, precision) combination once per process
+    and shares the resulting inference module across every session that asks for it.
+    Models are reference counted and freed when the last handle is released.
+    """
+
+    def __init__(self, loader=load_model):
+        self.loader = loader
+        self.lock = threading.Lock()
+        self.entries = {}  # key -> {"model", "refs", "bytes"}
+        self.loads = 0  # Times a model had to be built from disk
+        self.hits = 0  # Times an already loaded model was reused
+
+    def make_key(self, model_def, weights_path, img_size, device, backend="torch", precision="fp32"):
+        weights_path = os.path.abspath(weights_path) if weights_path is not None else None
+        return (os.path.abspath(model_def), weights_path, int(img_size), str(device), backend, precision)
+
+    def acquire(self, model_def, weights_path, img_size=416, device=None, backend="torch", precision="fp32"):
+        device = torch.device(device) if device is not None else default_device()
+        key = self.make_key(model_def, weights_path, img_size, device, backend, precision)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                model = self.loader(model_def, weights_path, img_size=img_size, device=device, backend=backend, precision=precision)
+                entry = {"model": model, "refs": 0, "bytes": model_bytes(model)}
+                self.entries[key] = entry
+                self.loads += 1
+            else:
+                self.hits += 1
+            entry["refs"] += 1
+            return ModelHandle(self, key, entry["model"])
+
+    def release(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            entry["refs"] -= 1
+            if entry["refs"] <= 0:
+                # Last session closed: drop the model so its memory can be reclaimed
+                del self.entries[key]
+                if key[3].startswith("cuda"):
+                    torch.cuda.empty_cache()
+
+    def memory_report(self):
+        """
+        Returns one row per loaded model with its size, the number of sessions sharing it
+        and the memory saved compared to loading one copy per session
+        """
+        with self.lock:
+            report = []
+            for (model_def, weights_path, img_size, device, backend, precision), entry in self.entries.items():
+                report.append(
+                    {
+                        "model_def": model_def,
+                        "weights_path": weights_path,
+                        "img_size": img_size,
+                        "device": device,
+                        "backend": backend,
+                        "precision": precision,
+                        "sessions": entry["refs"],
+                        "model_bytes": entry["bytes"],
+                        "saved_bytes": entry["bytes"] * (entry["refs"] - 1),
+                    }
+                )
+            return report
+
+    def format_memory_report(self):
+        lines = ["Model registry: %d loads, %d reuses" % (self.loads, self.hits)]
+        for row in self.memory_report():
+            lines.append(
+                "+ %s (%s, %d px, %s, %s, %s): %d sessions, %.1f MB loaded, %.1f MB saved"
+                % (
+                    os.path.basename(row["model_def"]),
+                    os.path.basename(row["weights_path"] or "no weights"),
+                    row["img_size"],
+                    row["device"],
+                    row["backend"],
+                    row["precision"],
+                    row["sessions"],
+                    row["model_bytes"] / 2 ** 20,
+                    row["saved_bytes"] / 2 ** 20,
+                )
+            )
+        return "\n".join(lines)
+
+
+# Registry shared by every peer connection of the server
+model_registry = ModelRegistry()
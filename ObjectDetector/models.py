@@ -7,7 +7,7 @@ from torch.autograd import Variable
 import numpy as np
 
 from ObjectDetector.utils.parse_config import *
-from ObjectDetector.utils.utils import build_targets, to_cpu, non_max_suppression
+from ObjectDetector.utils.utils import build_targets, to_cpu, non_max_suppression, candidates_nms
 
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
@@ -83,6 +83,38 @@ def create_modules(module_defs):
     return hyperparams, module_list
 
 
+def activation_liveness(module_defs):
+    """
+    Finds which layer outputs are read back by 'route' and 'shortcut' layers.
+    Returns, for each layer, the absolute indices of the outputs it reads and
+    the indices of the outputs that are not needed anymore once it has run.
+    """
+    sources = []
+    last_use = {}
+    for i, module_def in enumerate(module_defs):
+        if module_def["type"] == "route":
+            layers = [int(x) for x in module_def["layers"].split(",")]
+        elif module_def["type"] == "shortcut":
+            layers = [int(module_def["from"])]
+        else:
+            layers = []
+        layers = [i + layer_i if layer_i < 0 else layer_i for layer_i in layers]
+        sources.append(layers)
+        for layer_i in layers:
+            last_use[layer_i] = i
+
+    release_after = [[] for _ in module_defs]
+    for layer_i, i in last_use.items():
+        release_after[i].append(layer_i)
+    return sources, release_after
+
+
+def activation_bytes(outputs):
+    """ Bytes held by the distinct tensors in 'outputs' """
+    tensors = {id(t): t for t in outputs if isinstance(t, torch.Tensor)}
+    return sum(t.numel() * t.element_size() for t in tensors.values())
+
+
 class Upsample(nn.Module):
     """ nn.Upsample is deprecated """
 
@@ -119,6 +151,7 @@ class YOLOLayer(nn.Module):
         self.metrics = {}
         self.img_dim = img_dim
         self.grid_size = 0  # grid size
+        self.inference_grids = {}  # (grid size, img dim, device, dtype) -> offsets used by inference()
 
     def compute_grid_offsets(self, grid_size, cuda=True):
         self.grid_size = grid_size
@@ -132,6 +165,60 @@ class YOLOLayer(nn.Module):
         self.anchor_w = self.scaled_anchors[:, 0:1].view((1, self.num_anchors, 1, 1))
         self.anchor_h = self.scaled_anchors[:, 1:2].view((1, self.num_anchors, 1, 1))
 
+    def inference_grid(self, grid_size, img_dim, device, dtype):
+        """ Cell offsets and anchors in input pixels, cached per grid size, input size, device and dtype """
+        key = (grid_size, img_dim, device, dtype)
+        grid = self.inference_grids.get(key)
+        if grid is None:
+            g = grid_size
+            stride = img_dim / grid_size
+            grid_x = torch.arange(g, device=device, dtype=dtype).repeat(g, 1)
+            grid_y = grid_x.t()
+            offsets = torch.stack((grid_x, grid_y), -1).view(1, 1, g, g, 2) * stride
+            anchors = torch.tensor(self.anchors, device=device, dtype=dtype)
+            grid = self.inference_grids[key] = (stride, offsets, anchors)
+        return grid
+
+    def inference(self, x, img_dim, conf_thres=None):
+        """
+        Eval-mode decoding that keeps no state on the layer, so a shared model can run it
+        from several threads. Without 'conf_thres' it returns the same (samples, boxes, 5 + classes)
+        output as forward(). With it, only cells whose objectness reaches 'conf_thres' are decoded,
+        and (candidates, image indices) are returned with one row per surviving cell.
+        """
+        num_samples = x.size(0)
+        grid_size = x.size(2)
+        stride, offsets, anchors = self.inference_grid(grid_size, img_dim, x.device, x.dtype)
+        prediction = x.view(num_samples, self.num_anchors, self.num_classes + 5, grid_size, grid_size).permute(0, 1, 3, 4, 2)
+
+        if conf_thres is None and torch.onnx.is_in_onnx_export():
+            # The ONNX exporter does not follow chained in-place updates of slices
+            prediction = torch.cat(
+                (
+                    torch.sigmoid(prediction[..., :2]) * stride + offsets,
+                    torch.exp(prediction[..., 2:4]) * anchors.view(1, self.num_anchors, 1, 1, 2),
+                    torch.sigmoid(prediction[..., 4:]),
+                ),
+                -1,
+            )
+            return prediction.view(num_samples, -1, self.num_classes + 5)
+
+        if conf_thres is None:
+            # Single copy of the raw output, decoded in place
+            prediction = prediction.contiguous() if not prediction.is_contiguous() else prediction.clone()
+            prediction[..., :2].sigmoid_().mul_(stride).add_(offsets)
+            prediction[..., 2:4].exp_().mul_(anchors.view(1, self.num_anchors, 1, 1, 2))
+            prediction[..., 4:].sigmoid_()
+            return prediction.view(num_samples, -1, self.num_classes + 5)
+
+        # Objectness is the only channel computed for every cell
+        image_i, anchor_i, cell_y, cell_x = (torch.sigmoid(prediction[..., 4]) >= conf_thres).nonzero(as_tuple=True)
+        candidates = prediction[image_i, anchor_i, cell_y, cell_x]
+        candidates[:, :2].sigmoid_().mul_(stride).add_(offsets[0, 0, cell_y, cell_x])
+        candidates[:, 2:4].exp_().mul_(anchors[anchor_i])
+        candidates[:, 4:].sigmoid_()
+        return candidates, image_i
+
     def forward(self, x, targets=None, img_dim=None):
 
         # Tensors for cuda support
@@ -232,39 +319,116 @@ class YOLOLayer(nn.Module):
 
 
 class Darknet(nn.Module):
-    """YOLOv3 object detection model"""
+    """
+    YOLOv3 object detection model. 'config_path' is a cfg file or the module definitions
+    parse_model_config already returned for one, hyperparameters block included
+    """
 
     def __init__(self, config_path, img_size=416):
         super(Darknet, self).__init__()
-        self.module_defs = parse_model_config(config_path)
+        if isinstance(config_path, str):
+            self.module_defs = parse_model_config(config_path)
+        else:
+            self.module_defs = [dict(module_def) for module_def in config_path]  # create_modules pops the first one
         self.hyperparams, self.module_list = create_modules(self.module_defs)
         self.yolo_layers = [layer[0] for layer in self.module_list if hasattr(layer[0], "metrics")]
         self.img_size = img_size
         self.seen = 0
         self.header_info = np.array([0, 0, 0, self.seen, 0], dtype=np.int32)
 
-    def forward(self, x, targets=None):
+        # Only outputs read back by route and shortcut layers are kept, until their last reader has run
+        self.layer_sources, self.release_after = activation_liveness(self.module_defs)
+        self.read_back = set(layer_i for layers in self.layer_sources for layer_i in layers)
+        self.release_activations = True  # False keeps every layer output until the end of the pass
+        self.track_activations = False  # True fills activation_stats on every forward pass
+        self.activation_stats = {}
+        self.fused = False  # True once fuse() folded the batch norms into the convolutions
+
+        # With "bf16", convolutions, upsampling and pooling run under bf16 autocast, except the
+        # layers in fp32_layers (by default the linear convolutions feeding the YOLO layers).
+        # YOLO decoding and NMS always run in fp32
+        self.precision = "fp32"
+        self.fp32_layers = set(i - 1 for i, module_def in enumerate(self.module_defs) if module_def["type"] == "yolo")
+
+    def forward(self, x, targets=None, conf_thres=None):
+        """
+        Without targets and in eval mode, YOLO layers use the stateless inference decoding.
+        If 'conf_thres' is also given, only candidates above it are returned, as
+        (candidates, image indices), ready for candidates_nms.
+        """
         img_dim = x.shape[2]
+        inference = targets is None and not self.training
         loss = 0
-        layer_outputs, yolo_outputs = [], []
+        layer_outputs, yolo_outputs = {}, []
+        peak_bytes = 0
         for i, (module_def, module) in enumerate(zip(self.module_defs, self.module_list)):
             if module_def["type"] in ["convolutional", "upsample", "maxpool"]:
-                x = module(x)
+                if self.precision == "bf16" and i not in self.fp32_layers:
+                    with torch.autocast(x.device.type, dtype=torch.bfloat16):
+                        x = module(x)
+                else:
+                    x = module(x.float())
             elif module_def["type"] == "route":
-                x = torch.cat([layer_outputs[int(layer_i)] for layer_i in module_def["layers"].split(",")], 1)
+                inputs = [layer_outputs[layer_i] for layer_i in self.layer_sources[i]]
+                x = torch.cat(inputs, 1) if len(inputs) > 1 else inputs[0]
             elif module_def["type"] == "shortcut":
-                layer_i = int(module_def["from"])
-                x = layer_outputs[-1] + layer_outputs[layer_i]
+                x = x + layer_outputs[self.layer_sources[i][0]]
             elif module_def["type"] == "yolo":
-                x, layer_loss = module[0](x, targets, img_dim)
-                loss += layer_loss
+                x = x.float()
+                if inference:
+                    x = module[0].inference(x, img_dim, conf_thres)
+                else:
+                    x, layer_loss = module[0](x, targets, img_dim)
+                    loss += layer_loss
                 yolo_outputs.append(x)
-            layer_outputs.append(x)
+            if i in self.read_back or not self.release_activations:
+                layer_outputs[i] = x
+
+            if self.track_activations:
+                peak_bytes = max(peak_bytes, activation_bytes([x] + list(layer_outputs.values())))
+            if self.release_activations:
+                for layer_i in self.release_after[i]:
+                    del layer_outputs[layer_i]
+
+        if self.track_activations:
+            self.activation_stats = {"peak_bytes": peak_bytes, "layers": len(self.module_list)}
+        if inference and conf_thres is not None:
+            candidates, image_i = zip(*yolo_outputs)
+            return to_cpu(torch.cat(candidates, 0)), to_cpu(torch.cat(image_i, 0))
         yolo_outputs = to_cpu(torch.cat(yolo_outputs, 1))
         return yolo_outputs if targets is None else (loss, yolo_outputs)
 
+    def detect(self, imgs, conf_thres, nms_thres):
+        """ Inference followed by Non-Maximum Suppression. Returns the detections of each image """
+        candidates, image_i = self(imgs, conf_thres=conf_thres)
+        return candidates_nms(candidates, image_i, imgs.size(0), nms_thres)
+
+    def fuse(self):
+        """
+        Folds every BatchNorm2d into the weights and bias of the convolution before it and
+        replaces it with an identity, so inference runs one pass per convolutional block.
+        Only for deployment: the running statistics are gone, so the model can no longer be
+        trained nor have weights loaded into it. Returns the model
+        """
+        if self.fused:
+            return self
+        for module_def, module in zip(self.module_defs, self.module_list):
+            if module_def["type"] != "convolutional" or not int(module_def["batch_normalize"]):
+                continue
+            conv_layer, bn_layer = module[0], module[1]
+            with torch.no_grad():
+                scale = bn_layer.weight / torch.sqrt(bn_layer.running_var + bn_layer.eps)
+                conv_layer.weight.mul_(scale.view(-1, 1, 1, 1))
+                bias = bn_layer.bias - bn_layer.running_mean * scale
+            conv_layer.bias = nn.Parameter(bias, requires_grad=conv_layer.weight.requires_grad)
+            module[1] = nn.Identity()
+        self.fused = True
+        return self
+
     def load_darknet_weights(self, weights_path):
         """Parses and loads the weights stored in 'weights_path'"""
+        if self.fused:
+            raise RuntimeError("Weights must be loaded before fusing the batch norms of the model")
 
         # Open the weights file
         with open(weights_path, "rb") as f:
@@ -321,6 +485,8 @@ class Darknet(nn.Module):
             @:param path    - path of the new weights file
             @:param cutoff  - save layers between 0 and cutoff (cutoff = -1 -> all are saved)
         """
+        if self.fused:
+            raise RuntimeError("A model with fused batch norms can not be saved as darknet weights")
         fp = open(path, "wb")
         self.header_info[3] = self.seen
         self.header_info.tofile(fp)
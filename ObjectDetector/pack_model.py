@@ -0,0 +1,36 @@
+from __future__ import division
+
+from utils.utils import *
+from model_registry import load_model
+from model_package import save_package, load_package
+
+import os
+import time
+import argparse
+
+import torch
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_def", type=str, default="config/yolov3-custom.cfg", help="path to model definition file")
+    parser.add_argument("--weights_path", type=str, default="weights/yolov3_ckpt_499.pth", help="path to .weights or .pth file")
+    parser.add_argument("--class_path", type=str, default="data/custom/classes.names", help="path to class label file")
+    parser.add_argument("--output", type=str, default="weights/yolov3-custom.pack", help="path of the model package")
+    parser.add_argument("--no_fuse", action="store_true", help="keep the batch norms instead of folding them")
+    opt = parser.parse_args()
+    print(opt)
+
+    model = load_model(opt.model_def, opt.weights_path, device=torch.device("cpu"), fuse=not opt.no_fuse)
+    save_package(model, opt.output, load_classes(opt.class_path))
+
+    # Check the package against the model it comes from
+    start = time.time()
+    packed = load_package(opt.output)
+    load_time = time.time() - start
+    imgs = torch.rand(1, 3, 416, 416)
+    with torch.no_grad():
+        difference = (packed.eval()(imgs) - model(imgs)).abs().max().item()
+    print(
+        "Packed %s (%.1f MB), loads in %.0f ms, max output difference %.2e"
+        % (opt.output, os.path.getsize(opt.output) / 2 ** 20, 1000 * load_time, difference)
+    )
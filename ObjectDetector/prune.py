@@ -0,0 +1,108 @@
+from __future__ import division
+
+from utils.utils import *
+from utils.parse_config import *
+from test import evaluate
+from model_registry import load_model
+from pruning import prune_model, model_flops
+
+from terminaltables import AsciiTable
+
+import os
+import sys
+import copy
+import time
+import shutil
+import argparse
+import subprocess
+
+import torch
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_def", type=str, default="config/yolov3-custom.cfg", help="path to model definition file")
+    parser.add_argument("--data_config", type=str, default="config/custom.data", help="path to data config file")
+    parser.add_argument("--weights_path", type=str, default="weights/yolov3_ckpt_499.pth", help="path to weights file")
+    parser.add_argument("--img_size", type=int, default=416, help="size of each image dimension")
+    parser.add_argument("--batch_size", type=int, default=8, help="size of each image batch")
+    parser.add_argument("--prune_ratios", type=str, default="0.3,0.5,0.7", help="fractions of the prunable channels to remove")
+    parser.add_argument("--channel_multiple", type=int, default=8, help="channels kept per layer are a multiple of this")
+    parser.add_argument("--fine_tune_epochs", type=int, default=10, help="epochs of train.py on each pruned model, 0 to skip")
+    parser.add_argument("--output_dir", type=str, default="weights/pruned", help="directory of the pruned cfgs and weights")
+    parser.add_argument("--iou_thres", type=float, default=0.5, help="iou threshold required to qualify as detected")
+    parser.add_argument("--conf_thres", type=float, default=0.001, help="object confidence threshold")
+    parser.add_argument("--nms_thres", type=float, default=0.5, help="iou thresshold for non-maximum suppression")
+    opt = parser.parse_args()
+    print(opt)
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    os.makedirs(opt.output_dir, exist_ok=True)
+
+    data_config = parse_data_config(opt.data_config)
+    valid_path = data_config["valid"]
+
+    # Channels are ranked on the batch norm scales, so the model is loaded with its batch norms
+    model = load_model(opt.model_def, opt.weights_path, opt.img_size, device, fuse=False)
+
+    def channels(model):
+        return sum(int(module_def["filters"]) for module_def in model.module_defs if module_def["type"] == "convolutional")
+
+    def latency(model):
+        timed_model = copy.deepcopy(model).eval().fuse()
+        imgs = torch.rand(1, 3, opt.img_size, opt.img_size, device=device)
+        with torch.no_grad():
+            timed_model(imgs)
+            start = time.time()
+            for _ in range(5):
+                timed_model(imgs)
+        return (time.time() - start) / 5
+
+    def mean_ap(model):
+        precision, recall, AP, f1, ap_class = evaluate(
+            model,
+            path=valid_path,
+            iou_thres=opt.iou_thres,
+            conf_thres=opt.conf_thres,
+            nms_thres=opt.nms_thres,
+            img_size=opt.img_size,
+            batch_size=opt.batch_size,
+        )
+        return AP.mean()
+
+    print("\n---- Evaluating %s ----" % opt.model_def)
+    rows = [[opt.model_def, "-", channels(model), model_flops(model), latency(model), mean_ap(model)]]
+
+    for prune_ratio in [float(ratio) for ratio in opt.prune_ratios.split(",")]:
+        pruned = prune_model(model, prune_ratio, opt.channel_multiple)
+        name = "%s-pruned%02d" % (os.path.splitext(os.path.basename(opt.model_def))[0], round(100 * prune_ratio))
+        config_path = os.path.join(opt.output_dir, name + ".cfg")
+        weights_path = os.path.join(opt.output_dir, name + ".pth")
+        write_model_config([pruned.hyperparams] + pruned.module_defs, config_path)
+        torch.save(pruned.state_dict(), weights_path)
+
+        if opt.fine_tune_epochs > 0:
+            # Recover the accuracy lost to pruning with the usual training loop, from the pruned weights
+            print("\n---- Fine-tuning %s for %d epochs ----" % (name, opt.fine_tune_epochs))
+            subprocess.run(
+                [
+                    sys.executable,
+                    "train.py",
+                    "--model_def", config_path,
+                    "--data_config", opt.data_config,
+                    "--pretrained_weights", weights_path,
+                    "--epochs", str(opt.fine_tune_epochs),
+                    "--batch_size", str(opt.batch_size),
+                    "--img_size", str(opt.img_size),
+                ],
+                check=True,
+            )
+            shutil.copy("checkpoints/yolov3_ckpt_%d.pth" % (opt.fine_tune_epochs - 1), weights_path)
+            pruned.load_state_dict(torch.load(weights_path, map_location=device))
+
+        print("\n---- Evaluating %s ----" % config_path)
+        rows.append([config_path, "%.2f" % prune_ratio, channels(pruned), model_flops(pruned), latency(pruned), mean_ap(pruned)])
+
+    table = [["Model", "Pruned", "Channels", "GFLOPs", "Latency", "mAP"]]
+    for config_path, prune_ratio, channel_count, flops, seconds, mAP in rows:
+        table += [[config_path, prune_ratio, channel_count, "%.1f" % (flops / 1e9), "%.0f ms" % (1000 * seconds), "%.5f" % mAP]]
+    print(AsciiTable(table).table)
@@ -0,0 +1,182 @@
+import torch
+import torch.nn as nn
+
+from ObjectDetector.backends import model_device
+from ObjectDetector.models import Darknet, activation_liveness
+
+
+def channel_groups(module_defs):
+    """
+    Groups the layers whose output channels must be pruned together. A shortcut adds its
+    two inputs channel by channel, so both and its own output share one set of channels;
+    upsampling, max pooling and single source routes pass their input channels through.
+    Returns the group representative of each layer
+    """
+    parent = list(range(len(module_defs)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i, j):
+        parent[find(i)] = find(j)
+
+    sources, _ = activation_liveness(module_defs)
+    for i, module_def in enumerate(module_defs):
+        if module_def["type"] == "shortcut":
+            union(i, i - 1)
+            union(i, sources[i][0])
+        elif module_def["type"] in ("upsample", "maxpool") and i > 0:
+            union(i, i - 1)
+        elif module_def["type"] == "route" and len(sources[i]) == 1:
+            union(i, sources[i][0])
+    return [find(i) for i in range(len(module_defs))]
+
+
+def prunable_groups(module_defs, groups):
+    """
+    Representatives of the groups whose channels can be pruned: every convolution in them is
+    batch normalized and their channels do not come from the input image or a concatenation.
+    The convolutions in front of the YOLO layers have no batch norm, so their groups are kept
+    """
+    sources, _ = activation_liveness(module_defs)
+    fixed = set()
+    for i, module_def in enumerate(module_defs):
+        if module_def["type"] == "convolutional" and not int(module_def["batch_normalize"]):
+            fixed.add(groups[i])
+        elif module_def["type"] in ("upsample", "maxpool") and i == 0:
+            fixed.add(groups[i])
+        elif module_def["type"] == "route" and len(sources[i]) > 1:
+            fixed.add(groups[i])
+
+    # A concatenation kept whole keeps each of its sources whole
+    changed = True
+    while changed:
+        changed = False
+        for i, module_def in enumerate(module_defs):
+            if module_def["type"] == "route" and groups[i] in fixed:
+                for source in sources[i]:
+                    if groups[source] not in fixed:
+                        fixed.add(groups[source])
+                        changed = True
+
+    return set(
+        groups[i]
+        for i, module_def in enumerate(module_defs)
+        if module_def["type"] == "convolutional" and groups[i] not in fixed
+    )
+
+
+def channel_importance(model, groups, prunable):
+    """ Mean |gamma| of the batch norms of each prunable group, one value per channel """
+    scales = {}
+    for i, (module_def, module) in enumerate(zip(model.module_defs, model.module_list)):
+        if groups[i] in prunable and module_def["type"] == "convolutional":
+            scales.setdefault(groups[i], []).append(module[1].weight.detach().abs().float().cpu())
+    return dict((group, torch.stack(gammas).mean(0)) for group, gammas in scales.items())
+
+
+def select_channels(importance, prune_ratio, channel_multiple=8):
+    """
+    Channels kept in each group. One global threshold removes the 'prune_ratio' least important
+    channels of the whole model; each group then keeps a multiple of 'channel_multiple' of its
+    most important channels, and never fewer than 'channel_multiple'
+    """
+    # Ranked rather than thresholded, so that ties (untrained scales are all 1) still remove channels
+    scores = torch.cat(list(importance.values()))
+    removed = torch.zeros(len(scores), dtype=torch.bool)
+    removed[scores.argsort(stable=True)[: int(prune_ratio * len(scores))]] = True
+    kept = {}
+    offset = 0
+    for group, score in importance.items():
+        count = len(score) - int(removed[offset : offset + len(score)].sum())
+        offset += len(score)
+        count = -(-count // channel_multiple) * channel_multiple
+        count = min(len(score), max(channel_multiple, count))
+        kept[group] = score.topk(count).indices.sort().values
+    return kept
+
+
+def prune_model(model, prune_ratio, channel_multiple=8):
+    """
+    Channel pruning of a Darknet guided by the scale (gamma) of its batch norms, which training
+    drives towards zero for filters the detector does not use. Channels are removed together
+    across shortcut and route dependencies, see channel_groups. Returns a new, smaller Darknet
+    on the device of 'model' with the remaining weights copied, 'model' is left untouched.
+    The bias of a removed channel still reaches the next layers through its activation and is
+    not compensated, the pruned model is meant to be fine-tuned
+    """
+    if model.fused:
+        raise RuntimeError("Prune the model before fusing its batch norms")
+    module_defs = model.module_defs
+    groups = channel_groups(module_defs)
+    prunable = prunable_groups(module_defs, groups)
+    kept = select_channels(channel_importance(model, groups, prunable), prune_ratio, channel_multiple)
+    sources, _ = activation_liveness(module_defs)
+
+    # Output channels kept by each layer, as indices into its original output channels
+    channels = int(model.hyperparams["channels"])
+    outputs = []
+    filters = []
+    for i, module_def in enumerate(module_defs):
+        previous = outputs[-1] if outputs else torch.arange(channels)
+        previous_filters = filters[-1] if filters else channels
+        if module_def["type"] == "convolutional":
+            count = int(module_def["filters"])
+            outputs.append(kept[groups[i]] if groups[i] in prunable else torch.arange(count))
+            filters.append(count)
+        elif module_def["type"] == "route":
+            offset = 0
+            indices = []
+            for source in sources[i]:
+                indices.append(outputs[source] + offset)
+                offset += filters[source]
+            outputs.append(torch.cat(indices))
+            filters.append(offset)
+        else:
+            outputs.append(previous)
+            filters.append(previous_filters)
+
+    pruned_defs = [dict(module_def) for module_def in module_defs]
+    for i, module_def in enumerate(pruned_defs):
+        if module_def["type"] == "convolutional":
+            module_def["filters"] = str(len(outputs[i]))
+    pruned = Darknet([dict(model.hyperparams)] + pruned_defs, img_size=model.img_size)
+    pruned.seen = model.seen
+
+    with torch.no_grad():
+        for i, module_def in enumerate(module_defs):
+            if module_def["type"] != "convolutional":
+                continue
+            out_idx = outputs[i].to(model_device(model))
+            in_idx = (outputs[i - 1] if i > 0 else torch.arange(channels)).to(out_idx.device)
+            source, target = model.module_list[i], pruned.module_list[i]
+            target[0].weight.copy_(source[0].weight[out_idx][:, in_idx])
+            if source[0].bias is not None:
+                target[0].bias.copy_(source[0].bias[out_idx])
+            if int(module_def["batch_normalize"]):
+                for name in ("weight", "bias", "running_mean", "running_var"):
+                    getattr(target[1], name).copy_(getattr(source[1], name)[out_idx])
+                target[1].num_batches_tracked.copy_(source[1].num_batches_tracked)
+    return pruned.to(model_device(model))
+
+
+def model_flops(model, img_size=None):
+    """ Floating point operations (2 per multiply-accumulate) of the convolutions for one image """
+    img_size = img_size or model.img_size
+    total = [0]
+
+    def count(module, inputs, output):
+        kernel = module.weight[0].numel()  # in_channels / groups * kernel height * kernel width
+        total[0] += 2 * kernel * output[0].numel()
+
+    hooks = [module.register_forward_hook(count) for module in model.modules() if isinstance(module, nn.Conv2d)]
+    try:
+        with torch.no_grad():
+            model(torch.zeros(1, 3, img_size, img_size, device=model_device(model)))
+    finally:
+        for hook in hooks:
+            hook.remove()
+    return total[0]
@@ -0,0 +1,46 @@
+import copy
+
+import torch
+import torch.nn as nn
+from torch.ao import quantization
+
+
+def quantization_engine():
+    """ Best quantized kernel library available on this CPU """
+    engines = torch.backends.quantized.supported_engines
+    for engine in ("x86", "fbgemm", "qnnpack"):
+        if engine in engines:
+            return engine
+    raise RuntimeError("This torch build has no quantized CPU kernels")
+
+
+def quantize_model(model, calibration_batches):
+    """
+    Static post-training int8 quantization of the convolutional blocks of a Darknet.
+    'model' must not be fused yet: each batch normalized block is fused into one conv, wrapped
+    between a quantize and a dequantize stub, and its activation ranges are calibrated on
+    'calibration_batches', an iterable of image batches. Routes, shortcuts, upsampling, the
+    linear convolutions in front of the YOLO layers and the YOLO decoding stay in fp32.
+    Returns a new int8 model for the cpu, 'model' is left untouched
+    """
+    if model.fused:
+        raise RuntimeError("Quantize the model before fusing its batch norms")
+    torch.backends.quantized.engine = quantization_engine()
+    qconfig = quantization.get_default_qconfig(torch.backends.quantized.engine)
+
+    quantized = copy.deepcopy(model).cpu().eval()
+    for i, (module_def, module) in enumerate(zip(quantized.module_defs, quantized.module_list)):
+        if module_def["type"] != "convolutional" or not int(module_def["batch_normalize"]):
+            continue
+        quantization.fuse_modules(module, [[f"conv_{i}", f"batch_norm_{i}"]], inplace=True)
+        block = nn.Sequential(quantization.QuantStub(), *module, quantization.DeQuantStub())
+        block.qconfig = qconfig
+        quantized.module_list[i] = block
+    quantized.fused = True  # Batch norms are folded, no weights can be loaded anymore
+
+    quantization.prepare(quantized, inplace=True)
+    with torch.no_grad():
+        for imgs in calibration_batches:
+            quantized(imgs.cpu())
+    quantization.convert(quantized, inplace=True)
+    return quantized
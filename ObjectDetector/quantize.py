@@ -0,0 +1,93 @@
+from __future__ import division
+
+from utils.utils import *
+from utils.datasets import *
+from utils.parse_config import *
+from test import evaluate
+from model_registry import load_model, int8_path
+from compiled import CompiledDarknet
+from quantization import quantize_model
+
+from terminaltables import AsciiTable
+
+import sys
+import time
+import argparse
+
+import torch
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_def", type=str, default="config/yolov3-custom.cfg", help="path to model definition file")
+    parser.add_argument("--data_config", type=str, default="config/custom.data", help="path to data config file")
+    parser.add_argument("--weights_path", type=str, default="weights/yolov3_ckpt_499.pth", help="path to weights file")
+    parser.add_argument("--img_size", type=int, default=416, help="size of each image dimension")
+    parser.add_argument("--batch_size", type=int, default=8, help="size of each image batch")
+    parser.add_argument("--calibration_images", type=int, default=64, help="validation images used to calibrate")
+    parser.add_argument("--max_ap_drop", type=float, default=0.02, help="largest AP drop accepted for any class")
+    parser.add_argument("--iou_thres", type=float, default=0.5, help="iou threshold required to qualify as detected")
+    parser.add_argument("--conf_thres", type=float, default=0.001, help="object confidence threshold")
+    parser.add_argument("--nms_thres", type=float, default=0.5, help="iou thresshold for non-maximum suppression")
+    opt = parser.parse_args()
+    print(opt)
+
+    data_config = parse_data_config(opt.data_config)
+    valid_path = data_config["valid"]
+    class_names = load_classes(data_config["names"])
+
+    # Quantized kernels only run on the cpu
+    device = torch.device("cpu")
+    model = load_model(opt.model_def, opt.weights_path, opt.img_size, device, fuse=False)
+
+    # Calibrate the activation ranges on the first validation images
+    dataset = ListDataset(valid_path, img_size=opt.img_size, augment=False, multiscale=False)
+    dataloader = torch.utils.data.DataLoader(
+        dataset, batch_size=opt.batch_size, shuffle=False, num_workers=1, collate_fn=dataset.collate_fn
+    )
+    num_batches = max(1, opt.calibration_images // opt.batch_size)
+    calibration_batches = (imgs for batch_i, (_, imgs, _) in zip(range(num_batches), dataloader))
+    print("\nCalibrating on %d images..." % min(num_batches * opt.batch_size, len(dataset)))
+    int8_model = quantize_model(model, calibration_batches)
+
+    # Accuracy of both models on the validation set
+    results = {}
+    for name, evaluated in (("fp32", model), ("int8", int8_model)):
+        print("\n---- Evaluating %s model ----" % name)
+        precision, recall, AP, f1, ap_class = evaluate(
+            evaluated,
+            path=valid_path,
+            iou_thres=opt.iou_thres,
+            conf_thres=opt.conf_thres,
+            nms_thres=opt.nms_thres,
+            img_size=opt.img_size,
+            batch_size=opt.batch_size,
+        )
+        results[name] = dict(zip(ap_class, AP))
+
+    ap_table = [["Index", "Class name", "fp32 AP", "int8 AP", "Drop"]]
+    worst_drop = 0.0
+    for c in sorted(results["fp32"]):
+        drop = results["fp32"][c] - results["int8"].get(c, 0.0)
+        worst_drop = max(worst_drop, drop)
+        ap_table += [[c, class_names[c], "%.5f" % results["fp32"][c], "%.5f" % results["int8"].get(c, 0.0), "%.5f" % drop]]
+    print(AsciiTable(ap_table).table)
+
+    # Latency of one image on each model
+    imgs = torch.rand(1, 3, opt.img_size, opt.img_size)
+    latencies = {}
+    with torch.no_grad():
+        for name, timed_model in (("fp32", model.fuse()), ("int8", int8_model)):
+            timed_model(imgs)
+            start = time.time()
+            for _ in range(5):
+                timed_model(imgs)
+            latencies[name] = (time.time() - start) / 5
+    print("Latency: fp32 %.0f ms, int8 %.0f ms" % (1000 * latencies["fp32"], 1000 * latencies["int8"]))
+
+    if worst_drop > opt.max_ap_drop:
+        print("Largest AP drop %.5f exceeds the budget of %.5f, the int8 model is not published" % (worst_drop, opt.max_ap_drop))
+        sys.exit(1)
+
+    path = int8_path(opt.model_def, opt.weights_path, opt.img_size)
+    CompiledDarknet.compile(int8_model, opt.img_size, device, path)
+    print("Largest AP drop %.5f within the budget of %.5f, int8 model published to %s" % (worst_drop, opt.max_ap_drop, path))
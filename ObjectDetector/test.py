@@ -4,6 +4,8 @@ from models import *
 from utils.utils import *
 from utils.datasets import *
 from utils.parse_config import *
+from model_registry import load_model
+from backends import backends, precisions, model_device
 
 import os
 import sys
@@ -21,7 +23,9 @@ import torch.optim as optim
 
 
 def evaluate(model, path, iou_thres, conf_thres, nms_thres, img_size, batch_size):
-    model.eval()
+    # Darknet, or a model of any other backend exposing detect()
+    if isinstance(model, torch.nn.Module):
+        model.eval()
 
     # Get dataloader
     dataset = ListDataset(path, img_size=img_size, augment=False, multiscale=False)
@@ -29,7 +33,7 @@ def evaluate(model, path, iou_thres, conf_thres, nms_thres, img_size, batch_size
         dataset, batch_size=batch_size, shuffle=False, num_workers=1, collate_fn=dataset.collate_fn
     )
 
-    Tensor = torch.cuda.FloatTensor if torch.cuda.is_available() else torch.FloatTensor
+    device = model_device(model)  # int8 and onnxruntime models run on the cpu even when cuda is available
 
     labels = []
     sample_metrics = []  # List of tuples (TP, confs, pred)
@@ -41,11 +45,10 @@ def evaluate(model, path, iou_thres, conf_thres, nms_thres, img_size, batch_size
         targets[:, 2:] = xywh2xyxy(targets[:, 2:])
         targets[:, 2:] *= img_size
 
-        imgs = Variable(imgs.type(Tensor), requires_grad=False)
+        imgs = Variable(imgs.to(device), requires_grad=False)
 
         with torch.no_grad():
-            outputs = model(imgs)
-            outputs = non_max_suppression(outputs, conf_thres=conf_thres, nms_thres=nms_thres)
+            outputs = model.detect(imgs, conf_thres=conf_thres, nms_thres=nms_thres)
 
         sample_metrics += get_batch_statistics(outputs, targets, iou_threshold=iou_thres)
 
@@ -68,6 +71,8 @@ if __name__ == "__main__":
     parser.add_argument("--nms_thres", type=float, default=0.5, help="iou thresshold for non-maximum suppression")
     parser.add_argument("--n_cpu", type=int, default=8, help="number of cpu threads to use during batch generation")
     parser.add_argument("--img_size", type=int, default=416, help="size of each image dimension")
+    parser.add_argument("--backend", type=str, default="torch", choices=backends, help="runtime of the detector")
+    parser.add_argument("--precision", type=str, default="fp32", choices=precisions, help="precision of the torch backend")
     opt = parser.parse_args()
     print(opt)
 
@@ -78,16 +83,11 @@ if __name__ == "__main__":
     class_names = load_classes(data_config["names"])
 
     # Initiate model
-    model = Darknet(opt.model_def).to(device)
-    if opt.weights_path.endswith(".weights"):
-        # Load darknet weights
-        model.load_darknet_weights(opt.weights_path)
-    else:
-        # Load checkpoint weights
-        model.load_state_dict(torch.load(opt.weights_path))
+    model = load_model(opt.model_def, opt.weights_path, opt.img_size, device, backend=opt.backend, precision=opt.precision)
 
     print("Compute mAP...")
 
+    start_time = time.time()
     precision, recall, AP, f1, ap_class = evaluate(
         model,
         path=valid_path,
@@ -102,4 +102,5 @@ if __name__ == "__main__":
     for i, c in enumerate(ap_class):
         print(f"+ Class '{c}' ({class_names[c]}) - AP: {AP[i]}")
 
-    print(f"mAP: {AP.mean()}")
\ No newline at end of file
+    print(f"mAP: {AP.mean()}")
+    print(f"Evaluated with the {opt.backend} backend in {opt.precision} in {time.time() - start_time:.1f} s")
\ No newline at end of file
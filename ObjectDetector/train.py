@@ -6,11 +6,14 @@ from utils.utils import *
 from utils.datasets import *
 from utils.parse_config import *
 from test import evaluate
+from model_registry import load_model
+from distillation import HeadOutputs, distillation_loss
 
 from terminaltables import AsciiTable
 
 import os
 import sys
+import copy
 import time
 import datetime
 import argparse
@@ -36,6 +39,9 @@ if __name__ == "__main__":
     parser.add_argument("--evaluation_interval", type=int, default=1, help="interval evaluations on validation set")
     parser.add_argument("--compute_map", default=False, help="if True computes mAP every tenth batch")
     parser.add_argument("--multiscale_training", default=True, help="allow for multi-scale training")
+    parser.add_argument("--teacher_def", type=str, default="config/yolov3-custom.cfg", help="model definition of the teacher")
+    parser.add_argument("--teacher_weights", type=str, help="if specified distills the teacher with these weights into the model")
+    parser.add_argument("--distill_weight", type=float, default=1.0, help="weight of the distillation loss")
     opt = parser.parse_args()
     print(opt)
 
@@ -63,6 +69,11 @@ if __name__ == "__main__":
         else:
             model.load_darknet_weights(opt.pretrained_weights)
 
+    # With a teacher, the YOLO heads of the model also learn from its heads on the same images
+    if opt.teacher_weights:
+        teacher = load_model(opt.teacher_def, opt.teacher_weights, opt.img_size, device)
+        student_heads, teacher_heads = HeadOutputs(model), HeadOutputs(teacher)
+
     # Get dataloader
     dataset = ListDataset(train_path, augment=True, multiscale=opt.multiscale_training)
     dataloader = torch.utils.data.DataLoader(
@@ -103,6 +114,11 @@ if __name__ == "__main__":
             targets = Variable(targets.to(device), requires_grad=False)
 
             loss, outputs = model(imgs, targets)
+            if opt.teacher_weights:
+                with torch.no_grad():
+                    teacher(imgs)
+                distill_loss = distillation_loss(student_heads, teacher_heads)
+                loss = loss + opt.distill_weight * distill_loss
             loss.backward()
 
             if batches_done % opt.gradient_accumulations:
@@ -133,10 +149,14 @@ if __name__ == "__main__":
                         if name != "grid_size":
                             tensorboard_log += [(f"{name}_{j+1}", metric)]
                 tensorboard_log += [("loss", loss.item())]
+                if opt.teacher_weights:
+                    tensorboard_log += [("distill_loss", distill_loss.item())]
                 logger.list_of_scalars_summary(tensorboard_log, batches_done)
 
             log_str += AsciiTable(metric_table).table
             log_str += f"\nTotal loss {loss.item()}"
+            if opt.teacher_weights:
+                log_str += f"\nDistillation loss {distill_loss.item()}"
 
             # Determine approximate time left for epoch
             epoch_batches_left = len(dataloader) - (batch_i + 1)
@@ -176,3 +196,28 @@ if __name__ == "__main__":
 
         if epoch % opt.checkpoint_interval == 0:
             torch.save(model.state_dict(), f"checkpoints/yolov3_ckpt_%d.pth" % epoch)
+
+    if opt.teacher_weights:
+        # Student against teacher on the validation set and on one image
+        student_heads.remove()
+        teacher_heads.remove()
+        table = [["Model", "Latency", "mAP"]]
+        for name, compared in (("student " + opt.model_def, copy.deepcopy(model)), ("teacher " + opt.teacher_def, teacher)):
+            compared.eval().fuse()
+            precision, recall, AP, f1, ap_class = evaluate(
+                compared,
+                path=valid_path,
+                iou_thres=0.5,
+                conf_thres=0.001,
+                nms_thres=0.5,
+                img_size=opt.img_size,
+                batch_size=8,
+            )
+            imgs = torch.rand(1, 3, opt.img_size, opt.img_size, device=device)
+            with torch.no_grad():
+                compared(imgs)
+                start = time.time()
+                for _ in range(5):
+                    compared(imgs)
+            table += [[name, "%.0f ms" % (1000 * (time.time() - start) / 5), "%.5f" % AP.mean()]]
+        print(AsciiTable(table).table)
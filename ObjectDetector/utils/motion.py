@@ -0,0 +1,64 @@
+import numpy as np
+
+
+class MotionGate(object):
+    """
+    Cheap change detector run before the model. Each frame is scaled by libav to a tiny
+    grayscale thumbnail and compared with the thumbnail of the last frame sent to the
+    detector. Frames whose mean absolute difference is below 'threshold' (fraction of the
+    full 0-255 range) are skipped, but never more than 'max_skipped' checks in a row so slow
+    drifts are eventually picked up. 'max_skipped' counts calls to should_infer(), not video
+    frames: a caller checking one frame in N may go N * max_skipped frames without a detection.
+    """
+
+    def __init__(self, threshold=0.02, size=(64, 48), max_skipped=30):
+        self.threshold = threshold
+        self.size = size
+        self.max_skipped = max_skipped
+        self.reference = None  # Thumbnail of the last frame sent to the detector
+        self.difference = None  # Per pixel change of the last compared thumbnail, as a fraction of 0-255
+        self.skipped_in_row = 0
+
+        self.frames = 0
+        self.skipped = 0
+        self.last_change = 0.0
+
+    def thumbnail(self, frame):
+        width, height = self.size
+        return frame.reformat(width=width, height=height, format="gray").to_ndarray().astype(np.int16)
+
+    def should_infer(self, frame, force=False):
+        """
+        Returns True if 'frame' changed enough since the last inferred frame to run the detector,
+        always with 'force'. Every frame the detector runs on must go through here, so the
+        reference and the difference map are those of the frame sent to it
+        """
+        self.frames += 1
+        thumbnail = self.thumbnail(frame)
+        if self.reference is None:
+            self.last_change = 1.0
+        else:
+            self.difference = np.abs(thumbnail - self.reference) / 255.0
+            self.last_change = float(self.difference.mean())
+
+        if (
+            not force
+            and self.reference is not None
+            and self.last_change < self.threshold
+            and self.skipped_in_row < self.max_skipped
+        ):
+            self.skipped += 1
+            self.skipped_in_row += 1
+            return False
+
+        self.reference = thumbnail
+        self.skipped_in_row = 0
+        return True
+
+    def metrics(self):
+        return {
+            "gated_frames": self.frames,
+            "skipped": self.skipped,
+            "skip_rate": self.skipped / self.frames if self.frames else 0.0,
+            "last_change": self.last_change,
+        }
@@ -20,6 +20,17 @@ def parse_model_config(path):
 
     return module_defs
 
+def write_model_config(module_defs, path):
+    """Writes module definitions, hyperparameters block first, as a layer configuration file"""
+    with open(path, 'w') as file:
+        for module_def in module_defs:
+            file.write('[%s]\n' % module_def['type'])
+            for key, value in module_def.items():
+                # batch_normalize=0 is added by parse_model_config, a written '0' would read as true
+                if key != 'type' and not (key == 'batch_normalize' and value == 0):
+                    file.write('%s=%s\n' % (key, value))
+            file.write('\n')
+
 def parse_data_config(path):
     """Parses the data configuration file"""
     options = dict()
@@ -0,0 +1,50 @@
+import torch
+
+
+class FramePreprocessor(object):
+    """
+    Turns an av.VideoFrame into the letterboxed 1x3xSxS float tensor the detector expects.
+    libav converts to RGB and scales to the letterbox content size in one reformat, and the
+    pixels are written straight into a preallocated input buffer whose padding never changes.
+    'frame_size' is the (width, height) the frame is stretched to before letterboxing, which
+    keeps the 4:3 geometry of the former 720x540 resize.
+    Buffers are handed out with each frame and must be given back with release() once the
+    detector is done with them.
+    """
+
+    def __init__(self, img_size=416, frame_size=(720, 540), pad_value=0.0):
+        self.img_size = img_size
+        self.frame_size = frame_size
+        self.pad_value = pad_value
+        self.free = []  # Buffers ready to be written
+
+        # Same geometry as pad_to_square followed by resize
+        frame_w, frame_h = frame_size
+        self.scale = img_size / max(frame_w, frame_h)
+        self.content_w = int(round(frame_w * self.scale))
+        self.content_h = int(round(frame_h * self.scale))
+        self.pad_x = (img_size - self.content_w) // 2
+        self.pad_y = (img_size - self.content_h) // 2
+
+    def letterbox(self):
+        """ (scale, pad_x, pad_y) needed by rescale_letterbox_boxes to map boxes back to 'frame_size' """
+        return self.scale, self.pad_x, self.pad_y
+
+    def acquire(self):
+        if self.free:
+            return self.free.pop()
+        return torch.full((1, 3, self.img_size, self.img_size), self.pad_value)
+
+    def release(self, buffer):
+        if buffer.shape == (1, 3, self.img_size, self.img_size):
+            self.free.append(buffer)
+
+    def __call__(self, frame):
+        # One libav pass: colour conversion and scaling to the content size
+        rgb = frame.reformat(width=self.content_w, height=self.content_h, format="rgb24").to_ndarray()
+
+        buffer = self.acquire()
+        content = buffer[0, :, self.pad_y : self.pad_y + self.content_h, self.pad_x : self.pad_x + self.content_w]
+        content.copy_(torch.from_numpy(rgb).permute(2, 0, 1))  # HWC uint8 -> CHW float
+        content.mul_(1.0 / 255)
+        return buffer, self.letterbox()
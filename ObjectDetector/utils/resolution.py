@@ -0,0 +1,68 @@
+class ResolutionController(object):
+    """
+    Chooses the detector input size of a session from a ladder of multiples of 32.
+    observe() is called with the end-to-end latency of every detector result and the
+    backlog of the detector, in full batches waiting (see BatchScheduler.backlog). The size
+    steps down after 'patience' consecutive results over 'target_latency' or with more than
+    'max_backlog' batches waiting, and steps up after 'patience' consecutive results under
+    'headroom' * 'target_latency' with no backlog.
+    Results are ignored for 'cooldown' observations after each change, while frames of the
+    former size are still in flight. Sizes below 'min_size' are never used.
+    """
+
+    def __init__(self, ladder=(288, 320, 416, 512), start=416, min_size=320, target_latency=0.2,
+                 headroom=0.6, max_backlog=1, patience=3, cooldown=2):
+        self.ladder = sorted(size for size in ladder if size >= min_size) or [max(ladder)]
+        self.index = min(range(len(self.ladder)), key=lambda i: abs(self.ladder[i] - start))
+        self.target_latency = target_latency
+        self.headroom = headroom
+        self.max_backlog = max_backlog
+        self.patience = patience
+        self.cooldown = cooldown
+        self.slow = 0  # Consecutive results asking for a smaller size
+        self.fast = 0  # Consecutive results allowing a larger size
+        self.settling = 0  # Observations left to ignore after a change
+
+        self.ups = 0
+        self.downs = 0
+        self.last_latency = 0.0
+
+    @property
+    def size(self):
+        return self.ladder[self.index]
+
+    def observe(self, latency, backlog=0):
+        """ Records one detector result and returns the input size to use from now on """
+        self.last_latency = latency
+        if self.settling > 0:
+            self.settling -= 1
+            return self.size
+
+        if latency > self.target_latency or backlog > self.max_backlog:
+            self.slow, self.fast = self.slow + 1, 0
+        elif latency < self.headroom * self.target_latency and backlog == 0:
+            self.slow, self.fast = 0, self.fast + 1
+        else:
+            self.slow = self.fast = 0
+
+        if self.slow >= self.patience and self.index > 0:
+            self.index -= 1
+            self.downs += 1
+            self.changed()
+        elif self.fast >= self.patience and self.index < len(self.ladder) - 1:
+            self.index += 1
+            self.ups += 1
+            self.changed()
+        return self.size
+
+    def changed(self):
+        self.slow = self.fast = 0
+        self.settling = self.cooldown
+
+    def metrics(self):
+        return {
+            "img_size": self.size,
+            "resolution_ups": self.ups,
+            "resolution_downs": self.downs,
+            "detection_latency_ms": 1000 * self.last_latency,
+        }
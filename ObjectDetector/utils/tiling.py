@@ -0,0 +1,103 @@
+import math
+
+import torch
+
+
+class FrameTiler(object):
+    """
+    Cuts overlapping square tiles out of the full resolution frame for small objects.
+    Each tile covers 'tile_side' frame pixels and is fed to the detector at 'img_size',
+    instead of the whole frame being shrunk to a single input. The frame is scaled once
+    by libav so that tiles are plain crops, and only tiles where the previous frame had
+    activity (tracked objects or motion) are cut, at most 'max_tiles' of them.
+    Boxes found in a tile are mapped to the 'frame_size' coordinates used by the rest of
+    the pipeline with rescale_letterbox_boxes and the ((scale x, scale y), pad_x, pad_y) of the tile.
+    """
+
+    def __init__(self, img_size=416, frame_size=(720, 540), tile_side=608, overlap=0.2, max_tiles=4,
+                 motion_thres=0.02):
+        self.img_size = img_size
+        self.frame_size = frame_size
+        self.tile_side = tile_side
+        self.overlap = overlap
+        self.max_tiles = max_tiles
+        self.motion_thres = motion_thres
+        self.geometry = None  # (frame width, frame height) the grid below was computed for
+        self.grid = []
+
+        self.frames = 0
+        self.tiles = 0
+
+    def positions(self, length):
+        # Tile origins evenly spread so that neighbours overlap by at least 'overlap'
+        if length <= self.img_size:
+            return [0]
+        count = int(math.ceil((length - self.img_size) / (self.img_size * (1 - self.overlap)))) + 1
+        step = (length - self.img_size) / (count - 1)
+        return [int(round(i * step)) for i in range(count)]
+
+    def layout(self, width, height):
+        """ Scaled frame size and tile origins in it, for a frame of 'width' x 'height' """
+        if self.geometry != (width, height):
+            scale = self.img_size / self.tile_side
+            self.scaled = (int(round(width * scale)), int(round(height * scale)))
+            self.grid = [(x, y) for y in self.positions(self.scaled[1]) for x in self.positions(self.scaled[0])]
+            self.geometry = (width, height)
+        return self.scaled, self.grid
+
+    def enabled(self, frame):
+        # Tiles only add detail when the frame is larger than what a tile covers
+        return frame.width > self.tile_side or frame.height > self.tile_side
+
+    def activity(self, tracks, difference):
+        """
+        Activity of each tile: tracked boxes (in 'frame_size' coordinates) overlapping it,
+        plus its share of motion in 'difference', the thumbnail change map of MotionGate
+        """
+        (scaled_w, scaled_h), grid = self.scaled, self.grid
+        to_scaled = scaled_w / self.frame_size[0], scaled_h / self.frame_size[1]
+        scores = []
+        for x, y in grid:
+            score = 0.0
+            for track in tracks:
+                x1, y1, x2, y2 = track.box
+                if (x1 * to_scaled[0] < x + self.img_size and x2 * to_scaled[0] > x
+                        and y1 * to_scaled[1] < y + self.img_size and y2 * to_scaled[1] > y):
+                    score += 1.0
+            if difference is not None:
+                thumb_h, thumb_w = difference.shape
+                region = difference[
+                    y * thumb_h // scaled_h : max(y * thumb_h // scaled_h + 1, (y + self.img_size) * thumb_h // scaled_h),
+                    x * thumb_w // scaled_w : max(x * thumb_w // scaled_w + 1, (x + self.img_size) * thumb_w // scaled_w),
+                ]
+                motion = float(region.mean())
+                if motion >= self.motion_thres:
+                    score += motion
+            scores.append(score)
+        return scores
+
+    def __call__(self, frame, tracks, difference=None):
+        """
+        Returns a (k, 3, img_size, img_size) tensor with the active tiles of 'frame' and the
+        letterbox of each, or (None, []) if no tile had activity
+        """
+        self.frames += 1
+        (scaled_w, scaled_h), grid = self.layout(frame.width, frame.height)
+        scores = self.activity(tracks, difference)
+        active = sorted((i for i, score in enumerate(scores) if score > 0), key=lambda i: -scores[i])[: self.max_tiles]
+        if not active:
+            return None, []
+
+        # One libav pass to the tile scale, tiles are then crops of it
+        rgb = torch.from_numpy(frame.reformat(width=scaled_w, height=scaled_h, format="rgb24").to_ndarray())
+        tiles = torch.zeros(len(active), 3, self.img_size, self.img_size)
+        letterboxes = []
+        scale = (scaled_w / self.frame_size[0], scaled_h / self.frame_size[1])  # Axes differ for a 16:9 frame
+        for tile, i in zip(tiles, active):
+            x, y = grid[i]
+            crop = rgb[y : y + self.img_size, x : x + self.img_size]
+            tile[:, : crop.shape[0], : crop.shape[1]].copy_(crop.permute(2, 0, 1))
+            letterboxes.append((scale, -x, -y))
+        tiles.mul_(1.0 / 255)
+        self.tiles += len(active)
+        return tiles, letterboxes
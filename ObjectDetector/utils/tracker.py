@@ -0,0 +1,117 @@
+class Track(object):
+    """
+    Object followed across frames. 'age' counts the frames since it was first detected,
+    'hits' the detector runs that found it
+    """
+
+    def __init__(self, track_id, box, conf, cls_pred):
+        self.id = track_id
+        self.box = box  # [x1, y1, x2, y2]
+        self.measured = box  # Box of the last detection matched to the track
+        self.conf = conf
+        self.cls_pred = cls_pred
+        self.velocity = [0.0, 0.0]  # Centre displacement per frame
+        self.age = 1
+        self.hits = 1
+        self.frames_since_update = 0
+        self.misses = 0  # Consecutive detector runs where the track was not found
+        self.announced = False
+
+    def center(self, box=None):
+        x1, y1, x2, y2 = box if box is not None else self.box
+        return (x1 + x2) / 2, (y1 + y2) / 2
+
+    def predict(self):
+        dx, dy = self.velocity
+        self.box = [self.box[0] + dx, self.box[1] + dy, self.box[2] + dx, self.box[3] + dy]
+        self.age += 1
+        self.frames_since_update += 1
+
+    def update(self, box, conf):
+        old_x, old_y = self.center(self.measured)
+        new_x, new_y = self.center(box)
+        self.box = self.measured = box
+        self.conf = conf
+        frames = max(self.frames_since_update, 1)
+        self.velocity = [(new_x - old_x) / frames, (new_y - old_y) / frames]
+        self.frames_since_update = 0
+        self.misses = 0
+        self.hits += 1
+
+
+def box_iou(box1, box2):
+    """ IoU of two [x1, y1, x2, y2] boxes """
+    inter_w = min(box1[2], box2[2]) - max(box1[0], box2[0])
+    inter_h = min(box1[3], box2[3]) - max(box1[1], box2[1])
+    if inter_w <= 0 or inter_h <= 0:
+        return 0.0
+    inter = inter_w * inter_h
+    area1 = (box1[2] - box1[0]) * (box1[3] - box1[1])
+    area2 = (box2[2] - box2[0]) * (box2[3] - box2[1])
+    return inter / (area1 + area2 - inter + 1e-16)
+
+
+class IoUTracker(object):
+    """
+    Lightweight multi-object tracker used between detector runs.
+    predict() is called once per video frame and moves every track with its constant velocity.
+    update() is called with the detector output (x1, y1, x2, y2, conf, cls_conf, cls_pred) and
+    greedily matches detections to tracks of the same class by IoU, falling back to centroid
+    distance for fast moving objects. Tracks not found in more than 'max_misses' consecutive
+    detector runs are dropped.
+    """
+
+    def __init__(self, iou_thres=0.3, centroid_thres=0.5, max_misses=2):
+        self.iou_thres = iou_thres
+        self.centroid_thres = centroid_thres  # Max centre distance relative to the track size
+        self.max_misses = max_misses
+        self.tracks = []
+        self.next_id = 0
+
+    def predict(self):
+        for track in self.tracks:
+            track.predict()
+
+    def affinity(self, track, box):
+        iou = box_iou(track.box, box)
+        if iou >= self.iou_thres:
+            return 1.0 + iou
+        # Centroid distance normalised by the track size, for objects that moved a lot
+        x, y = track.center()
+        size = max(track.box[2] - track.box[0], track.box[3] - track.box[1], 1e-6)
+        distance = (((box[0] + box[2]) / 2 - x) ** 2 + ((box[1] + box[3]) / 2 - y) ** 2) ** 0.5 / size
+        return 1.0 - distance if distance < self.centroid_thres else 0.0
+
+    def update(self, detections):
+        rows = []
+        for detection in detections:
+            if detection is not None:
+                rows += detection.tolist()
+
+        # Every (track, detection) pair of the same class, best affinities first
+        pairs = []
+        for t, track in enumerate(self.tracks):
+            for d, (x1, y1, x2, y2, conf, cls_conf, cls_pred) in enumerate(rows):
+                if int(cls_pred) == track.cls_pred:
+                    affinity = self.affinity(track, [x1, y1, x2, y2])
+                    if affinity > 0:
+                        pairs.append((affinity, t, d))
+        pairs.sort(reverse=True)
+
+        matched_tracks, matched_detections = set(), set()
+        for _, t, d in pairs:
+            if t in matched_tracks or d in matched_detections:
+                continue
+            matched_tracks.add(t)
+            matched_detections.add(d)
+            self.tracks[t].update(rows[d][:4], rows[d][4])
+
+        for t, track in enumerate(self.tracks):
+            if t not in matched_tracks:
+                track.misses += 1
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_misses]
+
+        for d, row in enumerate(rows):
+            if d not in matched_detections:
+                self.tracks.append(Track(self.next_id, row[:4], row[4], int(row[6])))
+                self.next_id += 1
@@ -5,6 +5,7 @@ import tqdm
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torchvision
 from torch.autograd import Variable
 import numpy as np
 import matplotlib.pyplot as plt
@@ -50,6 +51,18 @@ def rescale_boxes(boxes, current_dim, original_shape):
     return boxes
 
 
+def rescale_letterbox_boxes(boxes, letterbox):
+    """
+    Rescales bounding boxes from a letterboxed input back to the frame, given (scale, pad_x, pad_y).
+    'scale' may also be a (scale x, scale y) pair
+    """
+    scale, pad_x, pad_y = letterbox
+    scale_x, scale_y = scale if isinstance(scale, tuple) else (scale, scale)
+    boxes[:, [0, 2]] = (boxes[:, [0, 2]] - pad_x) / scale_x
+    boxes[:, [1, 3]] = (boxes[:, [1, 3]] - pad_y) / scale_y
+    return boxes
+
+
 def xywh2xyxy(x):
     y = x.new(x.shape)
     y[..., 0] = x[..., 0] - x[..., 2] / 2
@@ -223,10 +236,114 @@ def bbox_iou(box1, box2, x1y1x2y2=True):
     return iou
 
 
-def non_max_suppression(prediction, conf_thres=0.5, nms_thres=0.4):
+def batched_nms(boxes, scores, groups, nms_thres, weights=None, chunk_size=4096):
+    """
+    Greedy Non-Maximum Suppression of x1y1x2y2 'boxes' belonging to several groups
+    (e.g. image and class). Each group is suppressed on its own, with its exact coordinates.
+    Returns the indices of the kept boxes by decreasing score. If 'weights' is given,
+    also returns the kept boxes merged with every box they suppressed, weighted by 'weights'.
+    """
+    # The +1 pixel convention of bbox_iou is the plain IoU of boxes grown by one pixel
+    grown = boxes.clone()
+    grown[:, 2:] += 1
+    keep, merged = [], []
+    for group in groups.unique():
+        members = (groups == group).nonzero(as_tuple=True)[0]
+        kept = torchvision.ops.nms(grown[members], scores[members], nms_thres)
+        keep.append(members[kept])
+        if weights is None:
+            continue
+        # Each box is merged into the first kept box (by score) overlapping it, which is the one that
+        # suppressed it. box_iou computes the IoU of the grown boxes like nms did, so it takes the same
+        # decisions, and a kept box always owns itself
+        owner = torch.empty(members.size(0), dtype=torch.long, device=boxes.device)
+        for start in range(0, members.size(0), chunk_size):
+            iou = torchvision.ops.box_iou(grown[members[kept]], grown[members[start : start + chunk_size]])
+            overlap = iou > nms_thres
+            owner[start : start + chunk_size] = torch.where(overlap.any(0), overlap.byte().argmax(0), iou.argmax(0))
+        owner[kept] = torch.arange(kept.size(0), device=boxes.device)
+        box_weights = weights[members]
+        total = torch.zeros(kept.size(0), dtype=weights.dtype, device=weights.device).index_add_(0, owner, box_weights)
+        summed = torch.zeros((kept.size(0), 4), dtype=boxes.dtype, device=boxes.device)
+        summed.index_add_(0, owner, box_weights[:, None] * boxes[members])
+        merged.append(summed / total[:, None])
+
+    if not keep:
+        keep = torch.zeros(0, dtype=torch.long, device=boxes.device)
+        return keep if weights is None else (keep, boxes.new_zeros((0, 4)))
+    keep = torch.cat(keep)
+    order = (-scores[keep]).argsort()
+    if weights is None:
+        return keep[order]
+    return keep[order], torch.cat(merged)[order]
+
+
+def non_max_suppression(prediction, conf_thres=0.5, nms_thres=0.4, merge=True):
+    """
+    Removes detections with lower object confidence score than 'conf_thres' and performs
+    Non-Maximum Suppression to further filter detections. The whole batch is processed at once.
+    With 'merge', each kept box is replaced by the confidence weighted mean of the boxes it suppressed.
+    Returns detections with shape:
+        (x1, y1, x2, y2, object_conf, class_score, class_pred)
+    """
+    # Filter out confidence scores below threshold
+    image_i, box_i = (prediction[..., 4] >= conf_thres).nonzero(as_tuple=True)
+    return candidates_nms(prediction[image_i, box_i], image_i, len(prediction), nms_thres, merge)
+
+
+def candidates_nms(candidates, image_i, num_images, nms_thres=0.4, merge=True):
+    """
+    Non-Maximum Suppression of (center x, center y, width, height, conf, class scores...) rows
+    that already passed the confidence threshold. 'image_i' holds the image index of each row.
+    Returns a list with the detections of each image, or None if it has none.
+    """
+    output = [None for _ in range(num_images)]
+    if not candidates.size(0):
+        return output
+
+    # From (center x, center y, width, height) to (x1, y1, x2, y2)
+    boxes = xywh2xyxy(candidates[:, :4])
+    class_confs, class_preds = candidates[:, 5:].max(1, keepdim=True)
+    # Object confidence times class confidence
+    score = candidates[:, 4] * class_confs[:, 0]
+    detections = torch.cat((boxes, candidates[:, 4:5], class_confs.float(), class_preds.float()), 1)
+
+    # Boxes only suppress boxes of the same image and class
+    num_classes = candidates.size(1) - 5
+    groups = image_i * num_classes + class_preds[:, 0]
+    if merge:
+        keep, merged = batched_nms(boxes, score, groups, nms_thres, weights=candidates[:, 4])
+        detections = detections[keep]
+        detections[:, :4] = merged
+    else:
+        keep = batched_nms(boxes, score, groups, nms_thres)
+        detections = detections[keep]
+
+    image_i = image_i[keep]
+    for i in image_i.unique().tolist():
+        output[i] = detections[image_i == i]
+    return output
+
+
+def merge_detections(detections, nms_thres=0.4):
+    """
+    Merges the detections of several views of the same frame (e.g. overlapping tiles),
+    already in frame coordinates, with class-wise Non-Maximum Suppression.
+    Returns the kept detections or None if there are none
+    """
+    detections = [d for d in detections if d is not None and len(d)]
+    if not detections:
+        return None
+    detections = torch.cat(detections, 0)
+    keep = batched_nms(detections[:, :4], detections[:, 4] * detections[:, 5], detections[:, 6].long(), nms_thres)
+    return detections[keep]
+
+
+def non_max_suppression_loop(prediction, conf_thres=0.5, nms_thres=0.4):
     """
     Removes detections with lower object confidence score than 'conf_thres' and performs
-    Non-Maximum Suppression to further filter detections.
+    Non-Maximum Suppression to further filter detections, one image and one kept box at a time.
+    Former implementation, kept as the reference for non_max_suppression.
     Returns detections with shape:
         (x1, y1, x2, y2, object_conf, class_score, class_pred)
     """
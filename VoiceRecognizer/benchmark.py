@@ -0,0 +1,189 @@
+"""
+Benchmarks for the audio recognition pipeline. Run from the repository root, e.g.
+
+    python -m VoiceRecognizer.benchmark resample --seconds 30
+"""
+from __future__ import division
+
+import argparse
+import collections
+import time
+
+import av
+import numpy as np
+
+from VoiceRecognizer.resampling import StreamResampler
+from VoiceRecognizer.ring_buffer import AudioRingBuffer
+from VoiceRecognizer import vad
+
+
+def synthetic_frames(seconds, rate=48000, frame_duration_ms=20, channels=2):
+    """ Stereo s16 frames like the ones WebRTC delivers: a few tones plus noise """
+    samples = rate * frame_duration_ms // 1000
+    t = np.arange(int(seconds * rate)) / rate
+    signal = 6000 * np.sin(2 * np.pi * 220 * t) + 3000 * np.sin(2 * np.pi * 1700 * t)
+    signal += np.random.RandomState(0).normal(0, 300, len(t))
+    signal = signal.astype(np.int16)
+    frames = []
+    for i in range(len(signal) // samples):
+        chunk = signal[i * samples : (i + 1) * samples]
+        frame = av.AudioFrame.from_ndarray(
+            np.repeat(chunk, channels).reshape(1, -1), format="s16", layout="stereo" if channels == 2 else "mono"
+        )
+        frame.sample_rate = rate
+        frame.pts = i * samples
+        frames.append(frame)
+    return signal, frames
+
+
+def former_resample(frames, rate=16000):
+    """ Former path: libav to mono at the input rate, then an FFT resampling of each frame on its own """
+    from scipy import signal as scipy_signal
+    from av.audio.resampler import AudioResampler
+
+    resampler = AudioResampler("s16", "mono")
+    output = []
+    for frame in frames:
+        input_rate = frame.sample_rate
+        resampled = resampler.resample(frame)
+        resampled = resampled[0] if isinstance(resampled, list) else resampled
+        data16 = np.frombuffer(bytes(resampled.planes[0]), dtype=np.int16)[: resampled.samples]
+        resample_size = int(len(data16) / input_rate * rate)
+        output.append(np.array(scipy_signal.resample(data16, resample_size), dtype=np.int16).tobytes())
+    return output
+
+
+def stream_resample(frames, rate=16000):
+    resampler = StreamResampler(rate)
+    audio = AudioRingBuffer(frame_bytes=2 * rate * 20 // 1000)
+    output = []
+    for frame in frames:
+        for samples in resampler.resample(frame):
+            audio.write(samples)
+        for offset, view in audio.frames():
+            output.append(view.tobytes())
+        audio.release(audio.read_pos)
+    return output
+
+
+def bench_resample(opt):
+    """ CPU time per second of audio and error against resampling the whole signal at once """
+    from scipy import signal as scipy_signal
+
+    signal, frames = synthetic_frames(opt.seconds, opt.input_rate)
+    reference = scipy_signal.resample_poly(signal.astype(np.float64), 16000, opt.input_rate)
+    for name, resample in (("scipy per frame", former_resample), ("libav stream", stream_resample)):
+        start = time.process_time()
+        output = resample(frames)
+        cpu = time.process_time() - start
+        resampled = np.frombuffer(b"".join(output), dtype=np.int16).astype(np.float64)
+        # The libav filter delays its output, align on the cross-correlation peak before comparing
+        lag = int(np.argmax(np.correlate(resampled[:4000], reference[:4000], "full"))) - 3999
+        aligned = resampled[lag:] if lag > 0 else resampled
+        length = min(len(aligned), len(reference)) - 100
+        error = aligned[100:length] - reference[100:length]
+        print(
+            "%-16s %.2f ms CPU per second of audio, %d frames of %d bytes, error against whole signal resampling: "
+            "rms %.1f, max %.0f (signal rms %.0f)"
+            % (
+                name,
+                1000 * cpu / opt.seconds,
+                len(output),
+                len(output[0]) if output else 0,
+                np.sqrt(np.mean(error ** 2)),
+                np.abs(error).max(),
+                np.sqrt(np.mean(reference ** 2)),
+            )
+        )
+
+
+def synthetic_decisions(frames, seed=0):
+    """ VAD decisions alternating between speech and silence runs, with isolated flips in both """
+    rng = np.random.RandomState(seed)
+    decisions = []
+    speech = False
+    while len(decisions) < frames:
+        run = rng.randint(5, 150)
+        decisions += [speech != (rng.rand() < 0.15) for _ in range(run)]
+        speech = not speech
+    return decisions[:frames]
+
+
+def former_segments(decisions, frame_bytes=640, padding_frames=15, ratio=0.6):
+    """ Former vad_collector: counts the voiced frames of the whole padding on every frame """
+    ring_buffer = collections.deque(maxlen=padding_frames)
+    triggered = False
+    segments = []
+    start = None
+    for i, is_speech in enumerate(decisions):
+        frame = i * frame_bytes
+        frames = []
+        if not triggered:
+            ring_buffer.append((frame, is_speech))
+            num_voiced = len([f for f, speech in ring_buffer if speech])
+            if num_voiced > ratio * ring_buffer.maxlen:
+                triggered = True
+                for f, s in ring_buffer:
+                    frames.append(f)
+                ring_buffer.clear()
+        else:
+            frames.append(frame)
+            ring_buffer.append((frame, is_speech))
+            num_unvoiced = len([f for f, speech in ring_buffer if not speech])
+            if num_unvoiced > ratio * ring_buffer.maxlen:
+                triggered = False
+                frames.append(None)
+                ring_buffer.clear()
+        for f in frames:
+            if f is None:
+                segments.append((start, frame + frame_bytes))
+                start = None
+            elif start is None:
+                start = f
+    return segments
+
+
+def state_segments(decisions, frame_bytes=640, padding_frames=15, ratio=0.6):
+    state = vad.VadState(frame_bytes, 20, preroll_ms=20 * padding_frames, hangover_ms=20 * padding_frames, ratio=ratio)
+    segments = []
+    for i, is_speech in enumerate(decisions):
+        segment = state.push(i * frame_bytes, is_speech)
+        if segment is not None and segment[0] == vad.END:
+            segments.append((state.segment_start, segment[2]))
+    return segments
+
+
+def bench_vad(opt):
+    """ Time per frame of the VAD trigger logic, and the utterances of both implementations """
+    if opt.decisions:
+        # One decision per line or character, 1 for speech and 0 for silence, as recorded from webrtcvad
+        with open(opt.decisions) as f:
+            decisions = [c == "1" for c in f.read() if c in "01"]
+    else:
+        decisions = synthetic_decisions(opt.frames)
+    results = {}
+    for name, segments in (("rescanned padding", former_segments), ("incremental state", state_segments)):
+        start = time.perf_counter()
+        results[name] = segments(decisions)
+        elapsed = time.perf_counter() - start
+        print("%-18s %.2f us per frame, %d utterances" % (name, 1e6 * elapsed / len(decisions), len(results[name])))
+    print("Same utterances: %s" % (results["rescanned padding"] == results["incremental state"]))
+
+
+benchmarks = {
+    "resample": bench_resample,
+    "vad": bench_vad,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=sorted(benchmarks), help="benchmark to run")
+    parser.add_argument("--seconds", type=float, default=30, help="seconds of synthetic audio")
+    parser.add_argument("--input_rate", type=int, default=48000, help="sample rate of the received audio")
+    parser.add_argument("--frames", type=int, default=100000, help="synthetic VAD decisions of 20 ms frames")
+    parser.add_argument("--decisions", type=str, help="file of recorded VAD decisions (0/1) used instead")
+    opt = parser.parse_args()
+    print(opt)
+
+    benchmarks[opt.benchmark](opt)
@@ -0,0 +1,77 @@
+import collections
+import functools
+
+from thread_pools import get_pool, run_in_pool
+
+decode_workers = 2  # Threads feeding and finishing STT streams, shared by every audio session
+
+
+def get_executor():
+    return get_pool("stt-decode", decode_workers)
+
+
+class DecodeQueue(object):
+    """
+    Runs the decoding work of one audio session on the shared decode pool, one task at a time
+    and in submission order, since the chunks of a stream must be fed in order and before it
+    is finished. Tasks of different sessions run in parallel on the pool. 'on_result', if
+    given, is called back on the event loop with the return value of its task, and 'on_error'
+    with the exception of a task that failed.
+    Every method must be called from the event loop thread.
+    """
+
+    def __init__(self, executor=None):
+        self.executor = executor if executor is not None else get_executor()
+        self.tasks = collections.deque()  # (function, arguments, on_result, on_error), oldest first
+        self.running = False
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.max_backlog = 0  # Most tasks ever waiting behind the running one
+        self.busy_time = 0.0  # Seconds spent running tasks
+
+    def submit(self, function, *args, on_result=None, on_error=None):
+        self.submitted += 1
+        self.tasks.append((function, args, on_result, on_error))
+        self.max_backlog = max(self.max_backlog, len(self.tasks) - (0 if self.running else 1))
+        self._next()
+
+    def clear(self):
+        """
+        Drops the tasks not started yet and returns them as (function, arguments, on_result, on_error),
+        oldest first, so the caller can free what they hold. The running one still completes
+        """
+        dropped = list(self.tasks)
+        self.tasks.clear()
+        return dropped
+
+    def _next(self):
+        if self.running or not self.tasks:
+            return
+        function, args, on_result, on_error = self.tasks.popleft()
+        self.running = True
+        run_in_pool(self.executor, function, args, functools.partial(self._done, on_result, on_error))
+
+    def _done(self, on_result, on_error, result, error, elapsed):
+        self.running = False
+        self.busy_time += elapsed
+        if error is not None:
+            self.failed += 1
+            print("Decoding failed: %r" % error)
+            if on_error is not None:
+                on_error(error)
+        else:
+            self.completed += 1
+            if on_result is not None:
+                on_result(result)
+        self._next()
+
+    def metrics(self):
+        return {
+            "decode_tasks": self.submitted,
+            "decode_failed": self.failed,
+            "decode_backlog": len(self.tasks),
+            "decode_max_backlog": self.max_backlog,
+            "decode_task_ms": 1000 * self.busy_time / (self.completed + self.failed) if self.completed + self.failed else 0.0,
+        }
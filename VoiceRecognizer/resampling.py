@@ -0,0 +1,23 @@
+from av.audio.resampler import AudioResampler
+
+
+class StreamResampler(object):
+    """
+    Converts the received audio frames to 'rate' Hz mono s16 with one libav resampler for the
+    whole stream, so its filter state carries over from frame to frame and no frame boundary
+    is filtered twice. libav does not return the same number of samples for every frame (its
+    filter delay shortens the first one): the output is meant to be written to an
+    AudioRingBuffer, which cuts it into frames of the size the VAD expects
+    """
+
+    def __init__(self, rate=16000):
+        self.resampler = AudioResampler("s16", "mono", rate)
+        self.rate = rate
+
+    def resample(self, frame):
+        """ Resamples 'frame' and returns the int16 sample arrays libav produced for it """
+        output = self.resampler.resample(frame)
+        # Older PyAV versions return a single frame (or None) instead of a list
+        if not isinstance(output, list):
+            output = [output] if output is not None else []
+        return [resampled.to_ndarray().reshape(-1) for resampled in output]
@@ -0,0 +1,83 @@
+class AudioRingBuffer(object):
+    """
+    Audio front end of a session: one bytearray holding the resampled stream, written with
+    chunks of any size and read as frames of exactly 'frame_bytes' (20 ms of 16 kHz s16 audio
+    by default, a size webrtcvad accepts). The capacity is a multiple of the frame size and
+    frames start at multiples of it, so every frame is a contiguous memoryview of the buffer
+    and nothing is copied after the write. Positions are absolute byte offsets in the stream.
+    A frame handed out stays valid until the stream is released past it with release(); the
+    buffer grows rather than overwrite audio that is still held, and views taken before it grew
+    keep pointing to the former bytearray. Not thread safe, used from the event loop only
+    """
+
+    def __init__(self, frame_bytes=640, capacity_frames=64):
+        self.frame_bytes = frame_bytes
+        self.data = bytearray(frame_bytes * capacity_frames)
+        self.view = memoryview(self.data)
+        self.write_pos = 0  # End of the audio written
+        self.read_pos = 0  # End of the frames handed out
+        self.release_pos = 0  # Start of the audio still held by a reader
+
+        self.grows = 0
+
+    @property
+    def capacity(self):
+        return len(self.data)
+
+    def write(self, samples):
+        """ Appends 'samples', any bytes-like object or contiguous array, to the stream """
+        source = memoryview(samples).cast("B")
+        if self.write_pos - self.release_pos + len(source) > self.capacity:
+            self.grow(self.write_pos - self.release_pos + len(source))
+        start = self.write_pos % self.capacity
+        head = min(len(source), self.capacity - start)
+        self.view[start : start + head] = source[:head]
+        self.view[: len(source) - head] = source[head:]
+        self.write_pos += len(source)
+
+    def grow(self, needed):
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        data = bytearray(capacity)
+        view = memoryview(data)
+        # Held audio keeps its absolute positions, laid out again for the new capacity
+        for pos in range(self.release_pos, self.write_pos, self.frame_bytes):
+            end = min(pos + self.frame_bytes, self.write_pos)
+            start = pos % self.capacity
+            view[pos % capacity : pos % capacity + end - pos] = self.view[start : start + end - pos]
+        self.data, self.view = data, view
+        self.grows += 1
+
+    def frames(self):
+        """ Returns the (offset, memoryview) of every complete frame not handed out yet """
+        frames = []
+        while self.write_pos - self.read_pos >= self.frame_bytes:
+            start = self.read_pos % self.capacity
+            frames.append((self.read_pos, self.view[start : start + self.frame_bytes]))
+            self.read_pos += self.frame_bytes
+        return frames
+
+    def span(self, begin, end):
+        """ Views of the audio in [begin, end), frame aligned offsets of frames handed out and not released """
+        if begin < self.release_pos or end > self.read_pos or begin % self.frame_bytes or end % self.frame_bytes:
+            raise ValueError("Audio from %d to %d is not held by the buffer" % (begin, end))
+        views = []
+        while begin < end:
+            # At most two views, the range may wrap around the end of the buffer
+            start = begin % self.capacity
+            length = min(end - begin, self.capacity - start)
+            views.append(self.view[start : start + length])
+            begin += length
+        return views
+
+    def release(self, offset):
+        """ Lets the audio before 'offset' be overwritten, every view of it must be done with """
+        self.release_pos = max(self.release_pos, min(offset, self.read_pos))
+
+    def metrics(self):
+        return {
+            "audio_buffer_bytes": self.capacity,
+            "audio_held_bytes": self.write_pos - self.release_pos,
+            "audio_buffer_grows": self.grows,
+        }
@@ -0,0 +1,153 @@
+import threading
+
+
+def load_stt_model(model_path, scorer_path):
+    import stt
+
+    model = stt.Model(model_path)  # Deep Learning model
+    model.enableExternalScorer(scorer_path)  # Deep Learning scorer
+    return model
+
+
+class SttHandle(object):
+    """
+    Reference of one audio session to the shared STT model. Streams are opened per utterance
+    with open_stream() and given back with finish_stream() or free_stream().
+    Call release() once the session is done with the model
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.stream = None  # Stream of the utterance being decoded, if any
+        self.released = False
+
+    def open_stream(self):
+        """ Opens the stream of a new utterance, returns False if every stream is in use """
+        if self.stream is None:
+            self.stream = self.pool.open_stream()
+        return self.stream is not None
+
+    def take_stream(self):
+        """
+        Detaches the open stream from the session, e.g. to decode it on another thread.
+        It must then be given back with SttPool.finish_stream() or SttPool.free_stream()
+        """
+        stream, self.stream = self.stream, None
+        return stream
+
+    def finish_stream(self):
+        """ Decodes the open stream and returns its text, or None if no stream was open """
+        stream = self.take_stream()
+        return self.pool.finish_stream(stream) if stream is not None else None
+
+    def free_stream(self):
+        """ Discards the open stream without decoding it """
+        stream = self.take_stream()
+        if stream is not None:
+            self.pool.free_stream(stream)
+
+    def release(self):
+        if not self.released:
+            self.free_stream()
+            self.released = True
+            self.pool.release()
+
+
+class SttPool(object):
+    """
+    Loads the STT model and its scorer once per process and shares it across every audio
+    session. Sessions only cost a decoding stream while an utterance is being recognized, and
+    at most 'max_streams' of them are open at once: an utterance starting while every stream is
+    in use is not decoded. The model is freed when the last session releases it
+    """
+
+    def __init__(self, max_streams=4, loader=load_stt_model):
+        self.loader = loader
+        self.max_streams = max_streams
+        self.lock = threading.Lock()
+        self.model = None
+        self.paths = None  # (model path, scorer path) of the loaded model
+        self.sessions = 0
+        self.streams = 0  # Streams open now
+
+        self.loads = 0  # Times the model had to be loaded from disk
+        self.hits = 0  # Times the loaded model was reused by a new session
+        self.opened = 0
+        self.rejected = 0  # Utterances not decoded because every stream was in use
+        self.peak_streams = 0
+
+    def acquire(self, model_path, scorer_path):
+        with self.lock:
+            if self.model is None:
+                self.model = self.loader(model_path, scorer_path)
+                self.paths = (model_path, scorer_path)
+                self.loads += 1
+            elif self.paths != (model_path, scorer_path):
+                raise ValueError("The STT pool already holds %s with %s" % self.paths)
+            else:
+                self.hits += 1
+            self.sessions += 1
+            return SttHandle(self)
+
+    def release(self):
+        with self.lock:
+            self.sessions -= 1
+            if self.sessions <= 0:
+                # Last session closed: drop the model and its scorer so their memory can be reclaimed
+                self.sessions = 0
+                self.model = None
+                self.paths = None
+                # Streams still counted were lost by their sessions, they went with the model
+                self.streams = 0
+
+    def open_stream(self):
+        with self.lock:
+            if self.model is None or self.streams >= self.max_streams:
+                self.rejected += 1
+                return None
+            self.streams += 1
+            self.opened += 1
+            self.peak_streams = max(self.peak_streams, self.streams)
+            model = self.model
+        try:
+            return model.createStream()
+        except Exception:
+            self.close_stream()
+            raise
+
+    def close_stream(self):
+        with self.lock:
+            # Not below 0: a stream of a released model may be closed after the count was reset
+            self.streams = max(0, self.streams - 1)
+
+    def finish_stream(self, stream):
+        """ Decodes 'stream', returns its text and frees its place in the pool """
+        try:
+            return stream.finishStream()
+        finally:
+            self.close_stream()
+
+    def free_stream(self, stream):
+        """ Discards 'stream' and frees its place in the pool """
+        try:
+            stream.freeStream()
+        finally:
+            self.close_stream()
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "stt_loads": self.loads,
+                "stt_reuses": self.hits,
+                "stt_sessions": self.sessions,
+                "streams_open": self.streams,
+                "streams_peak": self.peak_streams,
+                "max_streams": self.max_streams,
+                "stream_occupancy": self.streams / self.max_streams,
+                "streams_opened": self.opened,
+                "utterances_rejected": self.rejected,
+            }
+
+
+# Pool shared by every peer connection of the server
+stt_pool = SttPool()
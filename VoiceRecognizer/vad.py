@@ -0,0 +1,67 @@
+import collections
+
+# Events returned by VadState.push
+START = "start"  # An utterance starts, with the pre-roll before it
+SPEECH = "speech"  # One more frame of the utterance
+END = "end"  # Last frame of the utterance
+
+
+class VadState(object):
+    """
+    Turns the per-frame decisions of a voice activity detector into utterances. While idle,
+    an utterance starts once more than 'ratio' of the last 'preroll_ms' of frames are voiced,
+    and those frames are part of it. It ends once more than 'ratio' of the last 'hangover_ms'
+    of frames are unvoiced. Only decisions are kept, in a window with running voiced counts:
+    frames are contiguous 'frame_bytes' pieces of one stream, identified by their byte offset,
+    and utterances are returned as offsets of that stream
+    """
+
+    def __init__(self, frame_bytes=640, frame_duration_ms=20, preroll_ms=300, hangover_ms=300, ratio=0.6):
+        self.frame_bytes = frame_bytes
+        self.preroll = max(1, preroll_ms // frame_duration_ms)  # Frames
+        self.hangover = max(1, hangover_ms // frame_duration_ms)  # Frames
+        self.ratio = ratio
+        self.window = collections.deque()  # Decisions of the last frames, oldest first
+        self.voiced = 0  # Voiced frames in the window
+        self.triggered = False
+        self.last_offset = None  # Offset of the last frame pushed
+        self.segment_start = None  # Offset of the first frame of the current utterance
+
+    def push(self, offset, is_speech):
+        """
+        Adds the decision of the frame at 'offset'. Returns None outside utterances, otherwise
+        (event, begin, end) with the byte range of the audio this frame adds to the utterance:
+        the pre-roll and the frame on START, the frame on SPEECH and END. The whole utterance
+        is (segment_start, end) on END
+        """
+        self.last_offset = offset
+        size = self.hangover if self.triggered else self.preroll
+        if len(self.window) == size:
+            self.voiced -= self.window.popleft()
+        self.window.append(is_speech)
+        self.voiced += is_speech
+        end = offset + self.frame_bytes
+
+        if not self.triggered:
+            if self.voiced > self.ratio * self.preroll:
+                self.triggered = True
+                self.segment_start = end - len(self.window) * self.frame_bytes
+                self.clear()
+                return START, self.segment_start, end
+            return None
+
+        if len(self.window) - self.voiced > self.ratio * self.hangover:
+            self.triggered = False
+            self.clear()
+            return END, offset, end
+        return SPEECH, offset, end
+
+    def clear(self):
+        self.window.clear()
+        self.voiced = 0
+
+    def held_from(self):
+        """ Offset of the oldest frame a later push may still return, None if there is none """
+        if self.triggered or not self.window:
+            return None
+        return self.last_offset + self.frame_bytes - len(self.window) * self.frame_bytes
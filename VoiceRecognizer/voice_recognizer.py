@@ -1,18 +1,24 @@
 import webrtcvad
 import collections
-import stt
 import numpy as np
-from scipy import signal
 from halo import Halo
 
-import queue
-
 from aiortc import MediaStreamTrack
-from av.audio.resampler import AudioResampler
+
+from VoiceRecognizer.stt_pool import stt_pool
+from VoiceRecognizer.decoding import DecodeQueue
+from VoiceRecognizer.resampling import StreamResampler
+from VoiceRecognizer.ring_buffer import AudioRingBuffer
+from VoiceRecognizer import vad
 
 MODEL = 'VoiceRecognizer/model.tflite'
 SCORER = 'VoiceRecognizer/scorer.scorer'
 
+def feed_frames(stream, frames):
+    # Executed on the decode pool, never on the event loop
+    for frame in frames:
+        stream.feedAudioContent(frame)
+
 class DetectionAudio(MediaStreamTrack):
 
     kind = "audio"
@@ -25,26 +31,28 @@ class DetectionAudio(MediaStreamTrack):
 
         self.vad = webrtcvad.Vad(3) # VAD of strength 3. It separes noise from voice.
         
-        self.resampler = AudioResampler("s16", "mono") # To resample audio
+        frame_duration_ms = 20 # Duration of each frame in ms
+        # To resample audio to mono at the rate of the recognizer
+        self.resampler = StreamResampler(self.RATE_PROCESS)
+        # Resampled audio, read in frames of the duration the VAD expects without copying them
+        self.audio = AudioRingBuffer(frame_bytes=2 * self.RATE_PROCESS * frame_duration_ms // 1000)
 
-        self.input_rate = None # Sample rate of input audio
         self.sample_rate = self.RATE_PROCESS # Desired sample rate
-        self.ratio = 0.6 # Ratio for detection
-        self.buffer_queue = queue.Queue() # Buffer for new frames
 
-        self.model = stt.Model(MODEL) # Deep Learning model
-        self.model.enableExternalScorer(SCORER) # Deep Learning scorer
+        # The model and its scorer are loaded once per process, the session only opens a stream per utterance
+        self.stt = stt_pool.acquire(MODEL, SCORER)
+        self.data_channel = None
+        # Feeding and finishing streams runs on the decode pool, in order, never on the event loop
+        self.decoder = DecodeQueue()
+        self.feeding = collections.deque() # Offsets of the first frame of every chunk waiting to be fed
 
-        frame_duration_ms = 20 # Duration of each frame in ms
         padding_duration_ms = 300 # Duration of whole padding in ms
-        num_padding_frames = padding_duration_ms // frame_duration_ms # Number of frames per padding
-
-        # Queue to store frames with is_speech result to process complete paddings
-        self.ring_buffer = collections.deque(maxlen=num_padding_frames)
-        self.triggered = False
+        # Sentences start when more than 60% of the padding before is voice, and end when more than 60% of the padding after is not
+        self.vad_state = vad.VadState(
+            self.audio.frame_bytes, frame_duration_ms, preroll_ms=padding_duration_ms, hangover_ms=padding_duration_ms, ratio=0.6
+        )
 
         self.spinner = Halo(spinner='line') # To create an animation while recognition
-        self.stream_context = self.model.createStream() # Model for recognition
 
         # Receives audio datachannel
         @peer_conn.on("datachannel")
@@ -55,68 +63,89 @@ class DetectionAudio(MediaStreamTrack):
                 def on_message(message): # On received message, print it
                     print(message)
 
+    def stop(self):
+        super().stop()
+        # Give the shared model back to the pool, it is freed with the last session. The decode task
+        # running now may still use the stream, so it is freed and the model released after it
+        if self.stt is not None:
+            for function, args, on_result, on_error in self.decoder.clear():
+                # A dropped finish task held the only reference to the stream of the last sentence
+                if function is stt_pool.finish_stream:
+                    self.decoder.submit(stt_pool.free_stream, *args)
+            stream = self.stt.take_stream()
+            if stream is not None:
+                self.decoder.submit(stt_pool.free_stream, stream)
+            self.decoder.submit(self.stt.release)
+            self.stt = None
+
+    def metrics(self):
+        metrics = stt_pool.metrics()
+        metrics.update(self.decoder.metrics())
+        metrics.update(self.audio.metrics())
+        return metrics
+
     # Object detector program
     # Activates for every new frame
     async def recv(self):
         frame = await self.track.recv() # Receives frame
-        self.input_rate = frame.sample_rate # Sets sample rate of received frame
-        frame = self.resampler.resample(frame) # Resample frame to make it 'mono'
-        self.buffer_queue.put(frame.planes[0].to_bytes()) # Puts frame's bytes inside buffer
-        self.detect() # Starts detection
-
-    # Resample a frame to 16000 Hz
-    # Used to complete previous resampling
-    def resample(self, data):
-        data16 = np.fromstring(string=data, dtype=np.int16) # Converts string to 1-D array
-        resample_size = int(len(data16) / self.input_rate * self.RATE_PROCESS) # Gets size of resample
-        resample = signal.resample(data16, resample_size) # Performs resample to array
-        resample16 = np.array(resample, dtype=np.int16) # Converts 1-D array into a normal array
-        return resample16.tostring() # Returns string from array
-
-    # Resample frames which needs resample
-    def frame_generator(self):
-        if self.input_rate == self.RATE_PROCESS:
-            return self.buffer_queue.get()
-        else: # Resample performed in case of different sample rate
-            return self.resample(self.buffer_queue.get())
-
-    # Gets when user is speaking or it is just noise
-    def vad_collector(self):
-        frame = self.frame_generator() # Gets frame
-
-        is_speech = self.vad.is_speech(frame, self.sample_rate) # Determines if frame contains speech or noise
-
-        frames = []
-        if not self.triggered:
-            self.ring_buffer.append((frame, is_speech)) # Adds to buffer frame with is_speech result
-            num_voiced = len([f for f, speech in self.ring_buffer if speech]) # Counts how many voiced frames exists
-            if num_voiced > self.ratio * self.ring_buffer.maxlen: # A lot of voice, it is a sentence
-                self.triggered = True
-                for f, s in self.ring_buffer:
-                    frames.append(f) # Appends everything to return it
-                self.ring_buffer.clear() # Clear buffer
-        else: # Executed when a sentence is determined
-            frames.append(frame) # Returns every frame
-            self.ring_buffer.append((frame, is_speech)) # Adds every frame and is_speech result to buffer
-            num_unvoiced = len([f for f, speech in self.ring_buffer if not speech]) # Counts how many non voiced frames exists
-            if num_unvoiced > self.ratio * self.ring_buffer.maxlen: # A lot of silence or noise, sentence has finished
-                self.triggered = False
-                frames.append(None) # Append None to point the end of the sentence
-                self.ring_buffer.clear() # Clear buffer
-                    
-        return frames
+        for samples in self.resampler.resample(frame): # Mono 16000 Hz samples of this frame
+            self.audio.write(samples) # Puts them inside buffer
+        for offset, frame in self.audio.frames(): # Every complete 20 ms frame and its offset in the stream
+            self.detect(offset, frame) # Starts detection
+        self.release_audio()
+
+    # Audio before the oldest frame still in the padding or waiting to be fed can be overwritten
+    def release_audio(self):
+        held = [self.audio.read_pos]
+        if self.vad_state.held_from() is not None:
+            held.append(self.vad_state.held_from())
+        if self.feeding:
+            held.append(self.feeding[0])
+        self.audio.release(min(held))
 
     # Detection of commands is performed
-    def detect(self):
-        frames = self.vad_collector() # Get frames with a sentence
-        for frame in frames:
-            if frame is not None: # If it is not none, is part of the sentence
-                self.spinner.start() # Starts animation of performing
-                self.stream_context.feedAudioContent(np.frombuffer(frame, np.int16)) # Introduce frame to recognizer
-            else:
-                self.spinner.stop() # Stops recognising animation
-                text = self.stream_context.finishStream() # Gets recognized command
-                if self.data_channel is not None:
-                    self.data_channel.send(text) # Send result through datachannel
-                print("Recognized: %s" % text)
-                self.stream_context = self.model.createStream() # Create new stream for recognition
+    def detect(self, offset, frame):
+        is_speech = self.vad.is_speech(frame, self.sample_rate) # Determines if frame contains speech or noise
+        segment = self.vad_state.push(offset, is_speech) # Audio the frame adds to a sentence, if any
+        if segment is None:
+            return
+        event, begin, end = segment
+        if event == vad.START: # First frames of the sentence, takes a stream
+            if not self.stt.open_stream():
+                print("Every recognition stream is in use, sentence skipped")
+        if self.stt.stream is not None:
+            self.spinner.start() # Starts animation of performing
+            self.feed(begin, end)
+        if event == vad.END: # A lot of silence or noise, sentence has finished
+            stream = self.stt.take_stream()
+            if stream is None:
+                self.spinner.stop()
+                return
+            # Gets recognized command on the decode pool and gives the stream back
+            self.decoder.submit(stt_pool.finish_stream, stream, on_result=self.recognized)
+
+    def feed(self, begin, end):
+        # Introduce frames to recognizer, on the decode pool after the ones fed before.
+        # The arrays are views of the audio buffer, held until they have been fed
+        self.feeding.append(begin)
+        frames = [np.frombuffer(view, np.int16) for view in self.audio.span(begin, end)]
+        stream = self.stt.stream
+        self.decoder.submit(feed_frames, stream, frames, on_result=self.fed, on_error=lambda error: self.feed_failed(stream))
+
+    def fed(self, _):
+        self.feeding.popleft()
+        self.release_audio()
+
+    # The chunk is done with even if feeding it failed. The sentence is dropped if it is still open
+    def feed_failed(self, stream):
+        if self.stt is not None and self.stt.stream is stream:
+            self.decoder.submit(stt_pool.free_stream, self.stt.take_stream())
+            self.spinner.stop()
+        self.fed(None)
+
+    # Called back on the event loop with the text of each sentence
+    def recognized(self, text):
+        self.spinner.stop() # Stops recognising animation
+        if self.data_channel is not None:
+            self.data_channel.send(text) # Send result through datachannel
+        print("Recognized: %s" % text)
@@ -16,6 +16,7 @@ ROOT = os.path.dirname(__file__)
 
 logger = logging.getLogger("peer_conn")
 peer_conns = dict() # Store every peer connection
+sessions = dict() # Recognizer of every track being received, by peer connection ID and kind
 
 html_urls = { # Endpoints for different webpages
     "/": "WebXRSite/public/hololens.html"
@@ -26,6 +27,15 @@ async def html(request):
     content = open(os.path.join(ROOT, html_urls[str(request.rel_url)]), "r", encoding="utf8").read()
     return web.Response(content_type="text/html", text=content)
 
+def format_metrics(metrics):
+    return ", ".join(
+        "%s=%s" % (name, round(value, 3) if isinstance(value, float) else value) for name, value in sorted(metrics.items())
+    )
+
+async def stats(request):
+    # Metrics of every running recognizer: skip rates, dropped frames, input size, cascade rates, STT pool occupancy...
+    return web.json_response({session: local_track.metrics() for session, local_track in sessions.items()})
+
 async def offer(request):
     # Offer requested from client
     params = await request.json()
@@ -56,21 +66,29 @@ async def offer(request):
         log_info("Track %s received", track.kind)
         blackHole = MediaBlackhole() # Redirects to trash for MediaStreamTrack to recognize and executes recv method
                                      # It could be redirected back again to the client, but we don't want it
+        local_track = None
         if track.kind == "audio":
             # In case of audio track, create audio recognizer element
-            local_audio = DetectionAudio(track, peer_conn)
-            blackHole.addTrack(local_audio) # Add track to black hole to execute recv method
+            local_track = DetectionAudio(track, peer_conn)
+            blackHole.addTrack(local_track) # Add track to black hole to execute recv method
             await blackHole.start()
         elif track.kind == "video":
             # In case of video track, create video recognizer element
-            local_video = DetectionVideo(track, peer_conn)
-            blackHole.addTrack(local_video) # Add track to black hole to execute recv method
+            local_track = DetectionVideo(track, peer_conn)
+            blackHole.addTrack(local_track) # Add track to black hole to execute recv method
             await blackHole.start()
+        session = "%s %s" % (peer_conn_id, track.kind)
+        if local_track is not None:
+            sessions[session] = local_track
 
         @track.on("ended")
         async def on_ended():
             # Stops black hole on ending
             await blackHole.stop()
+            if local_track is not None:
+                sessions.pop(session, None)
+                log_info("Track %s metrics: %s", track.kind, format_metrics(local_track.metrics()))
+                local_track.stop() # Releases shared resources held by the recognizer
             log_info("Track %s ended", track.kind)
 
     # Handle offer
@@ -95,6 +113,8 @@ async def on_shutdown(app):
     peer_conns.clear()
 
 if __name__ == "__main__":
+    logging.basicConfig()
+    logger.setLevel(logging.INFO) # Connection events and the metrics of every ended track
     cert_file = "WebXRSite/certs/cert.pem"
     key_file = "WebXRSite/certs/key.pem"
     ssl_context = ssl.SSLContext() # Load cert and key for SSL protocol (HTTPS)
@@ -104,6 +124,7 @@ if __name__ == "__main__":
     app = web.Application()
     app.on_shutdown.append(on_shutdown)
     app.router.add_post("/offer", offer)
+    app.router.add_get("/stats", stats)
     for key in html_urls.keys():
         app.router.add_get(key, html)
 
@@ -0,0 +1,31 @@
+import asyncio
+import concurrent.futures
+import time
+
+pools = {}  # Name -> process-wide thread pool
+
+
+def get_pool(name, max_workers):
+    """
+    Process-wide thread pool 'name', created on first use, where blocking work (model forward
+    passes, speech decoding...) runs away from the asyncio event loop
+    """
+    pool = pools.get(name)
+    if pool is None:
+        pool = pools[name] = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+    return pool
+
+
+def run_in_pool(pool, function, args, on_done):
+    """
+    Runs function(*args) on 'pool' and calls on_done(result, error, elapsed) back on the event
+    loop, with the exception raised (or "cancelled") as 'error' and the seconds it took.
+    Must be called from the event loop thread
+    """
+    started = time.time()
+
+    def done(future):
+        error = "cancelled" if future.cancelled() else future.exception()
+        on_done(future.result() if error is None else None, error, time.time() - started)
+
+    asyncio.get_event_loop().run_in_executor(pool, function, *args).add_done_callback(done)